@@ -2,16 +2,41 @@
 # pylama:ignore=E501
 
 import csv
+import hashlib
 import json
 import networkx
 import logging
+import os
+from lib.compressedwriter import add_compress_args, compress_method, \
+    open_compressed
+from lib.binarytopology import BinaryTopology, BinaryTopologyWriter
+from lib.edges import edge_blocks, formatted_edge_blocks, sparse_pairs
+from lib.graphmlwriter import GraphMLWriter
+from lib.latencycsv import Deduplicator, is_compressed, read_latency_csvs
+from lib.latencyindex import LatencyIndex
+from lib.quantilesketch import parse_statistic
 from statistics import mean
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, \
+    ArgumentTypeError
+from contextlib import ExitStack
 
 
 FORMAT = "%(asctime)s %(filename)s:%(lineno)d:%(funcName)s() %(levelname)s %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=FORMAT)
 
+GRAPH_DATA = {'preferdirectpaths': 'True'}
+
+# --collapse -> level of the latency hierarchy the nodes are collapsed to
+COLLAPSE_LEVELS = {'city': 'city2city', 'country': 'country2country'}
+
+# what can be set per --variant, and how to parse it
+VARIANT_OPTIONS = {
+    'output': str,
+    'max-latency': float,
+    'max-packetloss': float,
+    'packetloss-model': str,
+}
+
 
 def main(args):
     logging.info(
@@ -28,121 +53,299 @@ def main(args):
     logging.info("found global averages: {} mbit/s up, {} mbit/s down".format(
         speed['global_up_mbit'], speed['global_down_mbit']))
 
-    # since we have multiple latencies for each edge we need to callapse them
-    latencies = {
-        'ip2ip': {},
-        'city2city': {},
-        'country2country': {},
-        'global': {}
-    }
-    G = networkx.Graph(preferdirectpaths="True")
+    max_packetloss = model_max_packetloss(
+        args.packetloss_model, args.max_packetloss)
+    # (output, max latency, max packet loss) of every GraphML topology
+    topologies = [(args.output, args.max_latency, max_packetloss)] + [
+        (v['output'], v['max_latency'],
+         model_max_packetloss(v['packetloss_model'], v['max_packetloss']))
+        for v in args.variant]
 
-    logging.info(
-        "adding nodes using probes from {}...".format(args.input_latency))
-    # add nodes first
-    with open(args.input_latency, 'r') as inf:
-        reader = csv.DictReader(inf, delimiter=',')
-
-        for row in reader:
-            src_ip = row['src']
-            src_country = row['src_country']
-            dst_ip = row['dst']
-            dst_country = row['dst_country']
-            src_city = int(row['src_city'])  # MaxMind int code
-            dst_city = int(row['dst_city'])  # MaxMind int code
-            src_city_name = row['src_city_name']
-            dst_city_name = row['dst_city_name']
-            latency = float(row['latency'])
-
-            if src_ip not in G:
-                add_node(G, speed, src_ip, src_city, src_country, src_city_name)
-            if dst_ip not in G:
-                add_node(G, speed, dst_ip, dst_city, dst_country, dst_city_name)
-
-            track_latency(latencies, 'ip2ip', src_ip, dst_ip, latency)
-            if src_city is not None and dst_city is not None:
-                track_latency(
-                    latencies, 'city2city', src_city, dst_city,
-                    latency)
-            track_latency(
-                latencies, 'country2country', src_country, dst_country,
-                latency)
-            track_latency(
-                latencies, 'global', 'global', 'global',
-                latency)
-
-    total_edges = len(G) * len(G)
-    logging.info("adding {} total edges...".format(total_edges))
-    # loop back through to add latencies
-    num_completed_edges = 0
-    next_step = 0.1
-    for s in G:
-        for d in G:
-            max_packetloss = 0
-            # explicitly checking for all possible values for
-            # args.packetloss_model
-            if args.packetloss_model == 'zero':
-                max_packetloss = 0
-            elif args.packetloss_model == 'linear-latency':
-                max_packetloss = args.max_packetloss
-            else:
-                fail_hard('Unknown packet loss model %s' %
-                          (args.packetloss_model,))
-            add_edge(G, latencies, s, d, args.max_latency, max_packetloss)
-            num_completed_edges += 1
-        if num_completed_edges > total_edges * next_step:
-            logging.info("finished {}/{} edges".format(
-                num_completed_edges, total_edges))
-            next_step += 0.1
-
-    logging.info("writing graph to {}...".format(args.output))
-    networkx.write_graphml(G, args.output)
-
-
-def add_edge(G, latencies, s, d, max_latency, max_ploss):
-    if s in latencies['ip2ip'] and d in latencies['ip2ip'][s]:
-        latency_list = latencies['ip2ip'][s][d]
-    elif d in latencies['ip2ip'] and s in latencies['ip2ip'][d]:
-        latency_list = latencies['ip2ip'][d][s]
-    elif 'citycode' in G.nodes[s] and 'citycode' in G.nodes[d] and G.nodes[s]['citycode'] in latencies['city2city'] and G.nodes[d]['citycode'] in latencies['city2city'][G.nodes[s]['citycode']]:
-        latency_list = latencies['city2city'][G.nodes[s]['citycode']][G.nodes[d]['citycode']]
-    elif 'citycode' in G.nodes[d] and 'citycode' in G.nodes[s] and G.nodes[d]['citycode'] in latencies['city2city'] and G.nodes[s]['citycode'] in latencies['city2city'][G.nodes[d]['citycode']]:
-        latency_list = latencies['city2city'][G.nodes[d]['citycode']][G.nodes[s]['citycode']]
-    elif G.nodes[s]['countrycode'] in latencies['country2country'] and G.nodes[d]['countrycode'] in latencies['country2country'][G.nodes[s]['countrycode']]:
-        latency_list = latencies['country2country'][G.nodes[s]['countrycode']][G.nodes[d]['countrycode']]
-    elif G.nodes[d]['countrycode'] in latencies['country2country'] and G.nodes[s]['countrycode'] in latencies['country2country'][G.nodes[d]['countrycode']]:
-        latency_list = latencies['country2country'][G.nodes[d]['countrycode']][G.nodes[s]['countrycode']]
+    state = None
+    if args.state:
+        state = load_state(args, max_packetloss)
+        index = state['index']
+    elif args.load_index:
+        logging.info("loading latency index from {}...".format(
+            args.load_index))
+        index = LatencyIndex.load(args.load_index)
+        if index.statistic != args.statistic:
+            logging.warning("{} has {} latencies, ignoring --statistic".format(
+                args.load_index, index.statistic))
     else:
-        latency_list = latencies['global']['global']['global']
+        index = load_latency_index(args)
+        if args.save_index:
+            logging.info("saving latency index to {}...".format(
+                args.save_index))
+            index.save(args.save_index)
 
-    latency = mean(latency_list)
-    assert latency > 0
-    if latency > max_latency:
-        latency = max_latency
-    packetloss = latency/max_latency*max_ploss
+    if args.collapse != 'ip':
+        full_index = index
+        index, node_map = full_index.collapsed(COLLAPSE_LEVELS[args.collapse])
+        logging.info("collapsed {} nodes into {} {} nodes, writing which is "
+                     "which to {}...".format(
+                         len(full_index.nodes), len(index.nodes),
+                         args.collapse, args.collapse_map))
+        with open(args.collapse_map, 'w', newline='') as fd:
+            writer = csv.writer(fd)
+            writer.writerow(['ip', 'node'])
+            writer.writerows(zip(
+                full_index.nodes,
+                [index.nodes[i] for i in node_map.tolist()]))
 
-    G.add_edge(s, d, latency=float(latency), packetloss=float(packetloss))
+    nodes = [(ip, node_attributes(speed, ip, *index.node_info(ip)))
+             for ip in index.nodes]
 
+    pairs = None
+    num_edges = len(nodes) * (len(nodes) + 1) // 2
+    if args.sparse_k is not None:
+        logging.info("picking edges for a sparse topology with k={}...".format(
+            args.sparse_k))
+        pairs = sparse_pairs(index, args.sparse_k)
+        logging.info("keeping {} of {} edges".format(len(pairs[0]), num_edges))
+        num_edges = len(pairs[0])
+    if state is not None:
+        save_state(args, state, index, nodes, pairs, max_packetloss)
+        if args.no_graphml:
+            return
 
-def track_latency(latencies, latency_key, src_key, dst_key, latency):
-    if src_key in latencies[latency_key] and dst_key in latencies[latency_key][src_key]:
-        latencies[latency_key][src_key][dst_key].append(latency)
-    elif dst_key in latencies[latency_key] and src_key in latencies[latency_key][dst_key]:
-        latencies[latency_key][dst_key][src_key].append(latency)
-    else:
-        if src_key in latencies[latency_key]:
-            latencies[latency_key][src_key].setdefault(dst_key, []).append(latency)
-        elif dst_key in latencies[latency_key]:
-            latencies[latency_key][dst_key].setdefault(src_key, []).append(latency)
+    if args.output_binary:
+        logging.info("writing binary topology to {}...".format(
+            args.output_binary))
+        with BinaryTopologyWriter(
+                args.output_binary, nodes, GRAPH_DATA) as writer:
+            for src_idx, dst_idx, latency, packetloss in edge_blocks(
+                    index, args.max_latency, max_packetloss, pairs=pairs):
+                writer.add_edges(src_idx, dst_idx, latency, packetloss)
+        if args.no_graphml:
+            return
+
+    if args.writer == 'networkx':
+        logging.info("adding {} nodes and {} total edges...".format(
+            len(nodes), num_edges))
+        G = networkx.Graph(**GRAPH_DATA)
+        G.add_nodes_from(nodes)
+        for src_idx, dst_idx, latency, packetloss in edge_blocks(
+                index, args.max_latency, max_packetloss, pairs=pairs):
+            G.add_edges_from(zip(
+                [index.nodes[i] for i in src_idx.tolist()],
+                [index.nodes[j] for j in dst_idx.tolist()],
+                [{'latency': lat, 'packetloss': ploss} for lat, ploss in
+                 zip(latency.tolist(), packetloss.tolist())]))
+        logging.info("writing graph to {}...".format(args.output))
+        with open_compressed(args, args.output) as fd:
+            networkx.write_graphml(G, fd)
+        return
+
+    logging.info("writing {} nodes and {} total edges to {} using {} "
+                 "jobs...".format(len(nodes), num_edges,
+                                  ', '.join(t[0] for t in topologies),
+                                  args.jobs))
+    with ExitStack() as stack:
+        writers = []
+        for output, _, _ in topologies:
+            writer = GraphMLWriter(
+                stack.enter_context(open_compressed(args, output)),
+                GRAPH_DATA, [('latency', float), ('packetloss', float)])
+            writer.write_nodes(nodes)
+            writers.append(writer)
+        num_completed_edges = 0
+        next_step = 0.1
+        # every writer has the same nodes, so any of their edge formatters
+        # does for all of them
+        for block_len, data in formatted_edge_blocks(
+                index, writers[0].edge_formatter,
+                [limits for _, *limits in topologies], pairs=pairs,
+                jobs=args.jobs):
+            for writer, topology_data in zip(writers, data):
+                writer.write_formatted_edges(topology_data)
+            num_completed_edges += block_len
+            if num_completed_edges > num_edges * next_step:
+                logging.info("finished {}/{} edges".format(
+                    num_completed_edges, num_edges))
+                next_step += 0.1
+        for writer in writers:
+            writer.close()
+
+
+def model_max_packetloss(packetloss_model, max_packetloss):
+    ''' The packet loss of links with the max latency for the given model. '''
+    # explicitly checking for all possible values for packetloss_model
+    if packetloss_model == 'zero':
+        return 0
+    elif packetloss_model == 'linear-latency':
+        return max_packetloss
+    fail_hard('Unknown packet loss model %s' % (packetloss_model,))
+
+
+def parse_variant(s):
+    '''
+    Parse a --variant: comma separated option=value pairs, where output is
+    required and max-latency, max-packetloss, and packetloss-model default to
+    the values of the options of the same name.
+    '''
+    variant = {}
+    for item in s.split(','):
+        name, sep, value = item.partition('=')
+        if not sep or name not in VARIANT_OPTIONS:
+            raise ArgumentTypeError(
+                'expected comma separated NAME=VALUE with NAME one of {}, not '
+                '{}'.format(', '.join(VARIANT_OPTIONS), item))
+        variant[name.replace('-', '_')] = VARIANT_OPTIONS[name](value)
+    if 'output' not in variant:
+        raise ArgumentTypeError('a variant needs an output')
+    return variant
+
+
+def load_latency_index(args):
+    logging.info("loading probes and latencies from {}...".format(
+        ', '.join(args.input_latency)))
+    # since we have multiple latencies for each edge we need to collapse them
+    index = LatencyIndex(args.statistic, args.sketch_accuracy)
+    read_latency_csvs(
+        index, [(fname, 0, weight) for fname, weight in latency_inputs(args)],
+        dedup=None if args.no_dedup else Deduplicator(), jobs=args.jobs)
+    index.build()
+    return index
+
+
+def latency_inputs(args):
+    ''' (file name, weight) of every latency CSV to read rows from. '''
+    weights = args.input_weights or [1.0] * len(args.input_latency)
+    # weight 0: excluded
+    return [(fname, weight) for fname, weight in
+            zip(args.input_latency, weights) if weight > 0]
+
+
+def csv_fingerprint(fname, offset):
+    '''
+    Hash the end of the first offset bytes of fname, to notice when the latency
+    CSV was rewritten instead of just appended to.
+    '''
+    with open(fname, 'rb') as fd:
+        fd.seek(max(0, offset - 65536))
+        return hashlib.sha256(fd.read(min(offset, 65536))).hexdigest()
+
+
+def state_params(args, max_packetloss):
+    ''' Everything that, if it changes, means starting over. '''
+    return {
+        'input_latency': [os.path.abspath(fname)
+                          for fname in args.input_latency],
+        'input_weights': args.input_weights,
+        'dedup': not args.no_dedup,
+        'max_latency': args.max_latency,
+        'max_packetloss': max_packetloss,
+        'sparse_k': args.sparse_k,
+        'collapse': args.collapse,
+        'statistic': args.statistic,
+        'sketch_accuracy': args.sketch_accuracy,
+    }
+
+
+def load_state(args, max_packetloss):
+    '''
+    Build the latency index for --state, reading only the rows of the latency
+    CSVs that were appended since the last run if we can, or all of them if
+    not. Returns the state to hand to save_state() later.
+    '''
+    state_fname = os.path.join(args.state, 'state.json')
+    dedup_fname = os.path.join(args.state, 'dedup.npz')
+    params = state_params(args, max_packetloss)
+    inputs = latency_inputs(args)
+    old_state = None
+    if os.path.exists(state_fname):
+        with open(state_fname, 'r') as fd:
+            old_state = json.load(fd)
+        if old_state['params'] != params:
+            logging.info("parameters changed since the last run, starting "
+                         "over")
+            old_state = None
         else:
-            latencies[latency_key].setdefault(src_key, {}).setdefault(dst_key, []).append(latency)
+            for (fname, _), offset, fingerprint in zip(
+                    inputs, old_state['csv_offsets'],
+                    old_state['csv_fingerprints']):
+                if os.path.getsize(fname) < offset or \
+                        csv_fingerprint(fname, offset) != fingerprint:
+                    logging.info("{} was rewritten since the last run, "
+                                 "starting over".format(fname))
+                    old_state = None
+                    break
+    else:
+        os.makedirs(args.state, exist_ok=True)
+
+    dedup = None if args.no_dedup else Deduplicator()
+    if old_state is None:
+        index = LatencyIndex(args.statistic, args.sketch_accuracy)
+        offsets = [0] * len(inputs)
+        logging.info("loading probes and latencies from {}...".format(
+            ', '.join(fname for fname, _ in inputs)))
+    else:
+        index = LatencyIndex.load(os.path.join(args.state, 'index.npz'))
+        index.reopen()
+        if dedup is not None:
+            dedup = Deduplicator.load(dedup_fname)
+        offsets = old_state['csv_offsets']
+        logging.info("loading probes and latencies added to {} since bytes "
+                     "{}...".format(', '.join(fname for fname, _ in inputs),
+                                    ', '.join(map(str, offsets))))
+    # if we die before save_state() is done, the files in args.state don't
+    # match anymore and the next run has to start over
+    if os.path.exists(state_fname):
+        os.remove(state_fname)
+    offsets = read_latency_csvs(
+        index, [(fname, offset, weight) for (fname, weight), offset in
+                zip(inputs, offsets)], dedup=dedup, jobs=args.jobs)
+    index.build()
+    return {'index': index, 'params': params, 'inputs': inputs,
+            'csv_offsets': offsets, 'dedup': dedup,
+            'incremental': old_state is not None}
+
 
+def save_state(args, state, index, nodes, pairs, max_packetloss):
+    '''
+    Save the latency index and binary topology, made from index (which is a
+    collapsed version of the state's index with --collapse), in --state. If
+    load_state() only read new rows, the binary topology from the last run is
+    patched instead of being computed from scratch.
+    '''
+    state['index'].save(os.path.join(args.state, 'index.npz'))
+    if state['dedup'] is not None:
+        state['dedup'].save(os.path.join(args.state, 'dedup.npz'))
+    topo_fname = os.path.join(args.state, 'atlas.topology.npz')
+    base = None
+    # sparse and collapsed topologies are cheap to redo, and the edges of
+    # a sparse one can come and go, so only full meshes of IPs get patched
+    if state['incremental'] and pairs is None and index is state['index']:
+        base = BinaryTopology.load(topo_fname)
+        pairs = index.changed_pairs()
+        logging.info("patching {} edges of the binary topology in "
+                     "{}...".format(len(pairs[0]), topo_fname))
+    else:
+        logging.info("writing binary topology to {}...".format(topo_fname))
+    with BinaryTopologyWriter(
+            topo_fname, nodes, GRAPH_DATA, base=base) as writer:
+        for src_idx, dst_idx, latency, packetloss in edge_blocks(
+                index, args.max_latency, max_packetloss, pairs=pairs):
+            writer.add_edges(src_idx, dst_idx, latency, packetloss)
+    state_fname = os.path.join(args.state, 'state.json')
+    with open(state_fname + '.tmp', 'w') as fd:
+        json.dump({
+            'params': state['params'],
+            'csv_offsets': state['csv_offsets'],
+            'csv_fingerprints': [
+                csv_fingerprint(fname, offset) for (fname, _), offset in
+                zip(state['inputs'], state['csv_offsets'])],
+        }, fd)
+    os.replace(state_fname + '.tmp', state_fname)
 
-def add_node(G, speed, ip, city, country, city_name):
+
+def node_attributes(speed, ip, city, country, city_name):
     # prefer city, then country, then fall back to global average
-    if city is not None and city in speed['cities']:
-        bwup = mbit_to_kib(speed['cities'][city]['up_mbits'])
-        bwdown = mbit_to_kib(speed['cities'][city]['down_mbits'])
+    # city codes are ints, but they're keys in JSON so they're strings there
+    if city is not None and str(city) in speed['cities']:
+        bwup = mbit_to_kib(speed['cities'][str(city)]['up_mbits'])
+        bwdown = mbit_to_kib(speed['cities'][str(city)]['down_mbits'])
     elif country in speed['countries']:
         bwup = mbit_to_kib(speed['countries'][country]['up_mbits'])
         bwdown = mbit_to_kib(speed['countries'][country]['down_mbits'])
@@ -151,10 +354,9 @@ def add_node(G, speed, ip, city, country, city_name):
         bwdown = mbit_to_kib(speed['global_down_mbit'])
 
     if city is not None:
-        G.add_node(ip, bandwidthdown=int(bwdown), bandwidthup=int(bwup), ip=str(ip), citycode=str(city), countrycode=str(country), cityname=str(city_name))
+        return dict(bandwidthdown=int(bwdown), bandwidthup=int(bwup), ip=str(ip), citycode=str(city), countrycode=str(country), cityname=str(city_name))
     else:
-        G.add_node(ip, bandwidthdown=int(bwdown), bandwidthup=int(bwup), ip=str(ip), countrycode=str(country))
-        # G.node[ip]['citycode'] = city
+        return dict(bandwidthdown=int(bwdown), bandwidthup=int(bwup), ip=str(ip), countrycode=str(country))
 
 
 def mbit_to_kib(bw):
@@ -169,17 +371,99 @@ def fail_hard(*a, **kw):
 if __name__ == '__main__':
     p = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     p.add_argument(
-        '--input-latency', type=str, default='../latency/data/all-pairs.csv',
-        help='Final output from scripts in ../latency directory.')
+        '--input-latency', type=str, nargs='+',
+        default=['../latency/data/all-pairs.csv'],
+        help='Final output from scripts in ../latency directory. Can be many '
+        'files, like from different campaigns, which are all read into one '
+        'topology. They can be compressed with gzip, xz, bzip2, or zstd.')
+    p.add_argument(
+        '--input-weights', type=float, nargs='+', metavar='WEIGHT',
+        help='How much the latencies from each --input-latency count, in the '
+        'same order. For example, to make older campaigns count less. A '
+        'weight of 0 leaves that input out. Defaults to 1 for all.')
+    p.add_argument(
+        '--no-dedup', action='store_true',
+        help='Don\'t drop rows with the same measurement ID, source, and '
+        'destination as an earlier row, which otherwise happens for inputs '
+        'with a measurement ID column. Saves memory.')
     p.add_argument(
         '--input-bandwidth', type=str, default='../bandwidth/speed-data.json',
         help='Final output from scripts in ../bandwidth directory.')
+    p.add_argument(
+        '--save-index', type=str, metavar='FNAME',
+        help='After reading --input-latency, save the collapsed latencies to '
+        'this file so later runs can use --load-index instead.')
+    p.add_argument(
+        '--load-index', type=str, metavar='FNAME',
+        help='Use latencies saved with --save-index instead of reading '
+        '--input-latency.')
     p.add_argument(
         '-o', '--output', type=str, default='/dev/stdout',
-        help='Where to write final output XML network topology. Consider '
-        'leaving this as stdout and '
-        'piping through xz for compression. Recommended filename: '
-        'atlas.graphml.xml(.xz)')
+        help='Where to write final output XML network topology. Recommended '
+        'filename: atlas.graphml.xml(.xz)')
+    add_compress_args(p)
+    p.add_argument(
+        '--variant', type=parse_variant, action='append', default=[],
+        metavar='output=FNAME[,max-latency=MS][,...]',
+        help='Also write a topology with different latency and packet loss '
+        'parameters to FNAME, sharing all the work but the very last step '
+        'with the main topology. Can be given many times. Each is a comma '
+        'separated list of output, max-latency, max-packetloss, and '
+        'packetloss-model; the latter three default to the values of their '
+        'options. Only works with the stream writer.')
+    p.add_argument(
+        '--state', type=str, metavar='DIR',
+        help='Keep the collapsed latencies and the binary topology in this '
+        'directory between runs. Later runs then only read the rows appended '
+        'to --input-latency since the last one and only recompute the edges '
+        'those rows could change, unless --input-latency was rewritten or '
+        'the latency, packet loss, or sparseness parameters changed.')
+    p.add_argument(
+        '--output-binary', type=str, metavar='FNAME',
+        help='Also write the topology in a compact binary format to this '
+        'file, which ./02-binary-to-graphml.py can turn into GraphML later. '
+        'Recommended filename: atlas.topology.npz')
+    p.add_argument(
+        '--no-graphml', action='store_true',
+        help='Only write --output-binary, not the GraphML topology.')
+    p.add_argument(
+        '--writer', choices=['stream', 'networkx'], default='stream',
+        help='How to write the topology. Stream: write edges as they are '
+        'computed without ever holding all of them in memory. Networkx: build '
+        'a networkx.Graph and write it with networkx.write_graphml(), which '
+        'needs lots of memory but can be handy for debugging.')
+    p.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='NUM',
+        help='Number of processes to compute and format edges with when '
+        'using the stream writer. The output is the same for any number of '
+        'jobs.')
+    p.add_argument(
+        '--collapse', choices=['ip', 'city', 'country'], default='ip',
+        help='Make one node per IP, or collapse all the IPs in a city (or '
+        'country, for IPs without a city) or in a country into one node, '
+        'connected with city or country level latencies and with the '
+        'bandwidth of that city or country.')
+    p.add_argument(
+        '--collapse-map', type=str, default='atlas.collapse-map.csv',
+        metavar='FNAME',
+        help='With --collapse city or country, write which node every IP '
+        'was collapsed into to this CSV file.')
+    p.add_argument(
+        '--sparse-k', type=int, metavar='K',
+        help='Instead of a full mesh, only add edges between nodes we have '
+        'direct measurements for, plus each node\'s K lowest-latency edges '
+        'based on city, country, or global latency, plus edges to a gateway '
+        'node per country to keep the graph connected. Shadow routes between '
+        'the remaining pairs over the shortest path.')
+    p.add_argument(
+        '--statistic', type=str, default='mean',
+        help='What to collapse all the latencies measured between two IPs, '
+        'cities, or countries to: mean, median, or a percentile like p95. '
+        'Anything but the mean is estimated with a quantile sketch.')
+    p.add_argument(
+        '--sketch-accuracy', type=float, default=0.01,
+        help='Relative accuracy of median and percentile latencies. Smaller '
+        'is more accurate, but takes more memory.')
     p.add_argument(
         '--max-latency', type=float, default=300,
         help='If we would assign a latency to a link larger than this based '
@@ -196,4 +480,40 @@ if __name__ == '__main__':
         'packet loss. Linear-latency: the packet loss assigned to a link '
         'increases linearly as the latency of the link increases.')
     args = p.parse_args()
+    for variant in args.variant:
+        for name in VARIANT_OPTIONS:
+            variant.setdefault(name.replace('-', '_'),
+                               getattr(args, name.replace('-', '_')))
+    if args.variant and args.writer != 'stream':
+        fail_hard('--variant only works with the stream writer')
+    if args.variant and args.no_graphml:
+        fail_hard('--variant with --no-graphml would not write the variants')
+    if args.no_graphml and not (args.output_binary or args.state):
+        fail_hard('--no-graphml without --output-binary or --state would '
+                  'output nothing')
+    if args.input_weights is not None:
+        if len(args.input_weights) != len(args.input_latency):
+            fail_hard('Need one --input-weights per --input-latency')
+        if min(args.input_weights) < 0:
+            fail_hard('--input-weights can\'t be negative')
+    if args.state and any(map(is_compressed, args.input_latency)):
+        fail_hard('--state picks up where it left off in --input-latency, '
+                  'which only works with uncompressed files')
+    if args.state and (args.load_index or args.save_index):
+        fail_hard('--state keeps its own latency index, so it can\'t be '
+                  'used with --load-index or --save-index')
+    try:
+        parse_statistic(args.statistic)
+    except ValueError as e:
+        fail_hard(str(e))
+    if not 0 < args.sketch_accuracy < 1:
+        fail_hard('--sketch-accuracy must be between 0 and 1')
+    if args.sparse_k is not None and args.sparse_k < 0:
+        fail_hard('--sparse-k must not be negative')
+    if 'zstd' in [compress_method(args, fname) for fname in
+                  [args.output] + [v['output'] for v in args.variant]]:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            fail_hard('zstd compression needs the zstandard package')
     exit(main(args))
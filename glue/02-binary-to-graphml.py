@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# pylama:ignore=E501
+
+import logging
+import numpy
+from lib.binarytopology import BinaryTopology
+from lib.compressedwriter import add_compress_args, compress_method, \
+    open_compressed
+from lib.edges import row_blocks, upper_triangle_rows
+from lib.graphmlwriter import GraphMLWriter
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+
+FORMAT = "%(asctime)s %(filename)s:%(lineno)d:%(funcName)s() %(levelname)s %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+
+
+def main(args):
+    logging.info("loading binary topology from {}...".format(args.input))
+    topo = BinaryTopology.load(args.input)
+    num_nodes = len(topo.nodes)
+    logging.info("writing {} nodes and their edges to {}...".format(
+        num_nodes, args.output))
+    with open_compressed(args, args.output) as fd:
+        writer = GraphMLWriter(
+            fd, topo.graph_data, [('latency', float), ('packetloss', float)])
+        writer.write_nodes(topo.nodes)
+        for first_row, end_row in row_blocks(num_nodes, 100000):
+            src_idx, dst_idx = upper_triangle_rows(
+                num_nodes, first_row, end_row)
+            latency = topo.latency[src_idx, dst_idx]
+            # NaN: no edge between these nodes in a sparse topology
+            has_edge = ~numpy.isnan(latency)
+            src_idx, dst_idx = src_idx[has_edge], dst_idx[has_edge]
+            # str() of a float32 is its shortest round-tripping form, so the
+            # GraphML doesn't pretend to more precision than we stored
+            writer.write_edges(
+                src_idx.tolist(), dst_idx.tolist(),
+                latency[has_edge].astype(str).tolist(),
+                topo.packetloss[src_idx, dst_idx].astype(str).tolist())
+        writer.close()
+
+
+def fail_hard(*a, **kw):
+    logging.error(*a, **kw)
+    exit(1)
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        '-i', '--input', type=str, default='atlas.topology.npz',
+        help='Binary topology written by ./01-create-atlas.py '
+        '--output-binary.')
+    p.add_argument(
+        '-o', '--output', type=str, default='/dev/stdout',
+        help='Where to write the XML network topology. Recommended filename: '
+        'atlas.graphml.xml(.xz)')
+    add_compress_args(p)
+    args = p.parse_args()
+    if compress_method(args, args.output) == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            fail_hard('zstd compression needs the zstandard package')
+    exit(main(args))
@@ -0,0 +1,144 @@
+import json
+import numpy
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+
+class BinaryTopology:
+    '''
+    A topology as a node table and N x N float32 latency and packet loss
+    matrices, where row/column i is nodes[i]. Pairs of nodes without an edge
+    between them, like in a sparse topology, are NaN in both.
+
+    On disk it's an uncompressed .npz, so numpy.load() can read it like any
+    other, but load() memory maps the matrices straight out of the file
+    instead of reading them.
+    '''
+    def __init__(self, nodes, graph_data, latency, packetloss):
+        '''
+        nodes is a list of (node id, dict of attributes) and graph_data a dict
+        of graph attributes, like for GraphMLWriter.
+        '''
+        self.nodes = nodes
+        self.graph_data = graph_data
+        self.latency = latency
+        self.packetloss = packetloss
+
+    @staticmethod
+    def _mmap_member(fname, zf, name):
+        ''' Memory map the stored (not compressed) .npy member name of zf. '''
+        info = zf.getinfo(name)
+        assert info.compress_type == zipfile.ZIP_STORED
+        with open(fname, 'rb') as fd:
+            fd.seek(info.header_offset)
+            header = fd.read(30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            fd.seek(info.header_offset + 30 + name_len + extra_len)
+            version = numpy.lib.format.read_magic(fd)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                    numpy.lib.format.read_array_header_1_0(fd)
+            else:
+                shape, fortran_order, dtype = \
+                    numpy.lib.format.read_array_header_2_0(fd)
+            offset = fd.tell()
+        return numpy.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                            shape=shape, order='F' if fortran_order else 'C')
+
+    @staticmethod
+    def load(fname, mmap=True):
+        with zipfile.ZipFile(fname) as zf:
+            with zf.open('nodes.npy') as fd:
+                nodes = json.loads(str(numpy.load(fd)))
+            with zf.open('graph.npy') as fd:
+                graph_data = json.loads(str(numpy.load(fd)))
+            matrices = []
+            for name in ['latency.npy', 'packetloss.npy']:
+                if mmap:
+                    matrices.append(BinaryTopology._mmap_member(
+                        fname, zf, name))
+                else:
+                    with zf.open(name) as fd:
+                        matrices.append(numpy.load(fd))
+        return BinaryTopology([tuple(n) for n in nodes], graph_data,
+                              *matrices)
+
+
+class BinaryTopologyWriter:
+    '''
+    Write a BinaryTopology to fname one block of edges at a time. The
+    matrices are built in memory mapped temporary files next to fname, so
+    they don't have to fit in memory, and fname is only replaced once the new
+    topology is completely written.
+    '''
+    def __init__(self, fname, nodes, graph_data, base=None):
+        '''
+        If base is given, start from a copy of that BinaryTopology's edges
+        instead of no edges at all. Its nodes have to be the first nodes of
+        nodes, in the same order, and it may well be loaded from fname.
+        '''
+        self._fname = fname
+        self._nodes = nodes
+        self._graph_data = graph_data
+        self._tmp_dname = tempfile.mkdtemp(
+            prefix='.atlas-topology-', dir=os.path.dirname(fname) or '.')
+        shape = (len(nodes), len(nodes))
+        self._matrices = {
+            name: numpy.lib.format.open_memmap(
+                os.path.join(self._tmp_dname, name + '.npy'), mode='w+',
+                dtype=numpy.float32, shape=shape)
+            for name in ['latency', 'packetloss']}
+        for matrix in self._matrices.values():
+            matrix[:] = numpy.nan
+        if base is not None:
+            num_base = len(base.nodes)
+            assert [n for n, _ in base.nodes] == \
+                [n for n, _ in nodes[:num_base]]
+            self._matrices['latency'][:num_base, :num_base] = base.latency
+            self._matrices['packetloss'][:num_base, :num_base] = \
+                base.packetloss
+
+    def add_edges(self, src_idx, dst_idx, latency, packetloss):
+        ''' Set the latency and packet loss both ways between node pairs. '''
+        for name, values in [('latency', latency),
+                             ('packetloss', packetloss)]:
+            matrix = self._matrices[name]
+            matrix[src_idx, dst_idx] = values
+            matrix[dst_idx, src_idx] = values
+
+    def abort(self):
+        ''' Throw away everything without writing fname. '''
+        self._matrices = None
+        shutil.rmtree(self._tmp_dname)
+
+    def close(self):
+        for matrix in self._matrices.values():
+            matrix.flush()
+        self._matrices = None
+        tmp_fname = os.path.join(self._tmp_dname, 'topology.npz')
+        try:
+            with zipfile.ZipFile(tmp_fname, 'w', zipfile.ZIP_STORED,
+                                 allowZip64=True) as zf:
+                for name, data in [('nodes', self._nodes),
+                                   ('graph', self._graph_data)]:
+                    with zf.open(name + '.npy', 'w') as fd:
+                        numpy.lib.format.write_array(
+                            fd, numpy.array(json.dumps(data)))
+                for name in ['latency', 'packetloss']:
+                    zf.write(os.path.join(self._tmp_dname, name + '.npy'),
+                             name + '.npy')
+            os.replace(tmp_fname, self._fname)
+        finally:
+            shutil.rmtree(self._tmp_dname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *a):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,132 @@
+import gzip
+import lzma
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# output file name extension -> compression method
+EXTENSIONS = {'.xz': 'xz', '.gz': 'gzip', '.zst': 'zstd'}
+METHODS = ['none', 'xz', 'gzip', 'zstd']
+
+
+def method_for_fname(fname):
+    ''' Guess the compression method from fname's extension. '''
+    return EXTENSIONS.get(os.path.splitext(fname)[1], 'none')
+
+
+def _compress_func(method, level):
+    if method == 'xz':
+        preset = 6 if level is None else level
+        return lambda data: lzma.compress(
+            data, format=lzma.FORMAT_XZ, preset=preset)
+    elif method == 'gzip':
+        compresslevel = 6 if level is None else level
+        return lambda data: gzip.compress(
+            data, compresslevel=compresslevel, mtime=0)
+    assert method == 'zstd', 'Unknown compression method {}'.format(method)
+    # optional, only needed if someone actually asks for zstd
+    import zstandard
+    zstd_level = 3 if level is None else level
+    # ZstdCompressor objects aren't safe to share between threads
+    return lambda data: zstandard.ZstdCompressor(
+        level=zstd_level).compress(data)
+
+
+class ParallelCompressedWriter:
+    '''
+    Binary file-like object that cuts everything written to it into chunks,
+    compresses the chunks on a pool of threads, and writes the compressed
+    chunks to fd in order.
+
+    Every chunk becomes a complete xz stream, gzip member, or zstd frame. The
+    standard tools (xzcat, zcat, zstdcat) decompress such concatenations as if
+    they were one stream, the same as the output of xz -T or pigz.
+    '''
+    def __init__(self, fd, method, threads=None, level=None,
+                 chunk_size=16*1024*1024):
+        self._fd = fd
+        self._compress = _compress_func(method, level)
+        self._threads = threads or os.cpu_count() or 1
+        self._chunk_size = chunk_size
+        self._buf = []
+        self._buf_len = 0
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buf_len += len(data)
+        if self._buf_len >= self._chunk_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        if not self._buf_len:
+            return
+        chunk = b''.join(self._buf)
+        self._buf, self._buf_len = [], 0
+        self._pending.append(self._pool.submit(self._compress, chunk))
+        # keep every thread busy, but don't let finished chunks pile up
+        while len(self._pending) > 2 * self._threads:
+            self._fd.write(self._pending.popleft().result())
+
+    def flush(self):
+        self._fd.flush()
+
+    def close(self):
+        self._submit()
+        while self._pending:
+            self._fd.write(self._pending.popleft().result())
+        self._pool.shutdown()
+        self._fd.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+
+def add_compress_args(p):
+    ''' Add the options open_compressed() needs to the ArgumentParser p. '''
+    p.add_argument(
+        '--compress', choices=['auto'] + METHODS, default='auto',
+        help='How to compress the output topology. Auto: pick based on the '
+        'extension of --output (.xz, .gz, .zst), or don\'t compress if it has '
+        'none of those. Zstd needs the zstandard python package.')
+    p.add_argument(
+        '--compress-threads', type=int, metavar='NUM',
+        help='Number of threads to compress with. Defaults to the number of '
+        'CPUs.')
+    p.add_argument(
+        '--compress-level', type=int, metavar='LEVEL',
+        help='Compression level, with the same meaning as for the xz, gzip, '
+        'or zstd command line tools. Defaults to what those tools default to.')
+
+
+def compress_method(args, fname):
+    ''' The compression method the add_compress_args() options ask for. '''
+    if args.compress == 'auto':
+        return method_for_fname(fname)
+    return args.compress
+
+
+@contextmanager
+def open_compressed(args, fname):
+    '''
+    Open fname for writing bytes, compressing them on the way out like the
+    add_compress_args() options say.
+    '''
+    method = compress_method(args, fname)
+    with open(fname, 'wb') as fd:
+        if method == 'none':
+            yield fd
+            return
+        logging.info("compressing output with {} using {} threads".format(
+            method, args.compress_threads or os.cpu_count()))
+        with ParallelCompressedWriter(fd, method, args.compress_threads,
+                                      args.compress_level) as out:
+            yield out
@@ -0,0 +1,238 @@
+import numpy
+import os
+import tempfile
+from collections import deque
+from multiprocessing import Pool
+from lib.latencyindex import LatencyIndex
+
+
+def upper_triangle_rows(num_nodes, first_row, end_row):
+    '''
+    Return the (row, column) indices of the upper triangle, diagonal included,
+    of a num_nodes x num_nodes matrix for rows first_row up to end_row. Going
+    row by row this is exactly the set and order of edges networkx used to
+    end up with after adding every ordered pair of nodes.
+    '''
+    rows = numpy.arange(first_row, end_row)
+    row_len = num_nodes - rows
+    src_idx = numpy.repeat(rows, row_len)
+    # each row's columns count up from the diagonal
+    row_start = numpy.cumsum(row_len) - row_len
+    dst_idx = numpy.arange(len(src_idx)) - numpy.repeat(row_start - rows,
+                                                         row_len)
+    return src_idx, dst_idx
+
+
+def row_blocks(num_nodes, block_edges):
+    '''
+    Yield (first_row, end_row) ranges of the upper triangle with roughly
+    block_edges edges in each, covering every edge once and in order.
+    '''
+    first_row = 0
+    while first_row < num_nodes:
+        end_row = first_row + 1
+        block_len = num_nodes - first_row
+        while end_row < num_nodes and \
+                block_len + num_nodes - end_row <= block_edges:
+            block_len += num_nodes - end_row
+            end_row += 1
+        yield first_row, end_row
+        first_row = end_row
+
+
+def sparse_pairs(index, k, block_edges=1000000):
+    '''
+    Pick the edges of a sparse topology and return them as (src indices, dst
+    indices) arrays in the same order as the upper triangle. Shadow routes
+    between nodes without an edge over the shortest path, so we keep
+
+    - every self loop,
+    - every pair with a direct ip2ip measurement,
+    - for each node, the k lowest-latency edges we'd have had to make up from
+      the city, country or global latency, and
+    - one gateway node per country, with the gateways connected to each other
+      and every node connected to its country's gateway, so the whole graph
+      stays connected no matter what.
+    '''
+    nodes = index.nodes
+    num_nodes = len(nodes)
+    measured_src, measured_dst = index.measured_pairs()
+    src = [numpy.arange(num_nodes), measured_src]
+    dst = [numpy.arange(num_nodes), measured_dst]
+
+    # measured or self: not a candidate for the k nearest made-up edges
+    measured = numpy.concatenate([
+        measured_src*num_nodes + measured_dst,
+        measured_dst*num_nodes + measured_src,
+        numpy.arange(num_nodes)*num_nodes + numpy.arange(num_nodes)])
+    measured.sort()
+    if k > 0:
+        rows_per_block = max(1, block_edges // max(num_nodes, 1))
+        for first_row in range(0, num_nodes, rows_per_block):
+            rows = numpy.arange(
+                first_row, min(first_row + rows_per_block, num_nodes))
+            row_src = numpy.repeat(rows, num_nodes)
+            row_dst = numpy.tile(numpy.arange(num_nodes), len(rows))
+            latency = index.lookup_pairs(row_src, row_dst)
+            codes = row_src*num_nodes + row_dst
+            pos = numpy.searchsorted(measured, codes)
+            pos[pos == len(measured)] = 0
+            latency[measured[pos] == codes] = numpy.inf
+            latency = latency.reshape(len(rows), num_nodes)
+            row_k = min(k, num_nodes - 1)
+            if row_k < 1:
+                continue
+            nearest = numpy.argpartition(latency, row_k - 1, axis=1)[:, :row_k]
+            keep = numpy.isfinite(numpy.take_along_axis(latency, nearest, 1))
+            src.append(numpy.repeat(rows, row_k)[keep.ravel()])
+            dst.append(nearest.ravel()[keep.ravel()])
+
+    # connect every node to its country's gateway, the node in that country
+    # with the most direct measurements
+    num_measured = numpy.bincount(
+        numpy.concatenate([measured_src, measured_dst]), minlength=num_nodes)
+    gateways = {}
+    for i, ip in enumerate(nodes):
+        country = index.node_info(ip)[1]
+        if country not in gateways or \
+                num_measured[i] > num_measured[gateways[country]]:
+            gateways[country] = i
+    for i, ip in enumerate(nodes):
+        src.append(numpy.array([i]))
+        dst.append(numpy.array([gateways[index.node_info(ip)[1]]]))
+    gateway_idx = numpy.array(sorted(gateways.values()), dtype=numpy.int64)
+    src.append(numpy.repeat(gateway_idx, len(gateway_idx)))
+    dst.append(numpy.tile(gateway_idx, len(gateway_idx)))
+
+    src, dst = numpy.concatenate(src), numpy.concatenate(dst)
+    codes = numpy.unique(
+        numpy.minimum(src, dst)*num_nodes + numpy.maximum(src, dst))
+    return codes // num_nodes, codes % num_nodes
+
+
+def blocks(num_nodes, pairs, block_edges):
+    '''
+    Yield (start, end) blocks of roughly block_edges edges each: rows of the
+    upper triangle if pairs is None, otherwise slices of the pairs arrays.
+    '''
+    if pairs is None:
+        yield from row_blocks(num_nodes, block_edges)
+        return
+    for start in range(0, len(pairs[0]), block_edges):
+        yield start, min(start + block_edges, len(pairs[0]))
+
+
+def block_pairs(num_nodes, pairs, start, end):
+    '''
+    Return the (src indices, dst indices) arrays of the edges in the given
+    block from blocks().
+    '''
+    if pairs is None:
+        return upper_triangle_rows(num_nodes, start, end)
+    return (numpy.asarray(pairs[0][start:end]),
+            numpy.asarray(pairs[1][start:end]))
+
+
+def limit_latency(latency, max_latency, max_ploss):
+    '''
+    Cap latencies at max_latency and return them along with the packet loss
+    for each, which grows linearly with latency up to max_ploss.
+    '''
+    latency = numpy.minimum(latency, max_latency)
+    return latency, latency/max_latency*max_ploss
+
+
+def edge_block(index, pairs, start, end, max_latency, max_ploss):
+    '''
+    Return (src indices, dst indices, latencies, packet losses) arrays for
+    the edges in the given block from blocks().
+    '''
+    src_idx, dst_idx = block_pairs(len(index.nodes), pairs, start, end)
+    latency = index.lookup_pairs(src_idx, dst_idx)
+    assert (latency > 0).all()
+    return (src_idx, dst_idx) + limit_latency(latency, max_latency, max_ploss)
+
+
+def edge_blocks(index, max_latency, max_ploss, pairs=None,
+                block_edges=100000):
+    '''
+    Yield every edge_block() of the topology, in order. The topology is a full
+    mesh if pairs is None, otherwise just the edges in pairs (like from
+    sparse_pairs()).
+    '''
+    for start, end in blocks(len(index.nodes), pairs, block_edges):
+        yield edge_block(index, pairs, start, end, max_latency, max_ploss)
+
+
+# state of a worker process in formatted_edge_blocks(), set up once per
+# process by _init_worker() instead of being sent along with every block
+_worker = {}
+
+
+def _init_worker(index_dname, formatter, limits, has_pairs):
+    _worker['index'] = LatencyIndex.attach(index_dname)
+    _worker['pairs'] = None
+    if has_pairs:
+        _worker['pairs'] = tuple(
+            numpy.load(os.path.join(index_dname, 'pairs', name + '.npy'),
+                       mmap_mode='r') for name in ['src', 'dst'])
+    _worker['formatter'] = formatter
+    _worker['limits'] = limits
+
+
+def _format_block(index, pairs, formatter, start, end, limits):
+    src_idx, dst_idx = block_pairs(len(index.nodes), pairs, start, end)
+    latency = index.lookup_pairs(src_idx, dst_idx)
+    assert (latency > 0).all()
+    src_idx, dst_idx = src_idx.tolist(), dst_idx.tolist()
+    formatted = []
+    for max_latency, max_ploss in limits:
+        limited, packetloss = limit_latency(latency, max_latency, max_ploss)
+        formatted.append(formatter.format(
+            src_idx, dst_idx, limited.tolist(), packetloss.tolist()))
+    return len(src_idx), formatted
+
+
+def _format_block_in_worker(block):
+    start, end = block
+    return _format_block(
+        _worker['index'], _worker['pairs'], _worker['formatter'], start, end,
+        _worker['limits'])
+
+
+def formatted_edge_blocks(index, formatter, limits, pairs=None, jobs=1,
+                          block_edges=100000):
+    '''
+    Yield (number of edges, list of GraphML bytes from formatter) for every
+    block of edges in the topology (see edge_blocks()), in order. limits is a
+    list of (max latency, max packet loss), and there is GraphML for each of
+    them in that order, all sharing the latency lookups.
+
+    With more than one job, blocks are computed and formatted by that many
+    worker processes. They all memory map one copy of the index (and pairs)
+    from a temporary directory instead of each getting their own. Blocks are
+    still yielded in order, so the output is the same for any number of jobs.
+    '''
+    block_iter = blocks(len(index.nodes), pairs, block_edges)
+    if jobs <= 1:
+        for start, end in block_iter:
+            yield _format_block(index, pairs, formatter, start, end, limits)
+        return
+    with tempfile.TemporaryDirectory(prefix='atlas-index-') as dname:
+        index.share(dname)
+        if pairs is not None:
+            os.mkdir(os.path.join(dname, 'pairs'))
+            for name, array in zip(['src', 'dst'], pairs):
+                numpy.save(os.path.join(dname, 'pairs', name + '.npy'), array)
+        with Pool(jobs, initializer=_init_worker, initargs=(
+                dname, formatter, limits, pairs is not None)) as pool:
+            pending = deque()
+            for block in block_iter:
+                pending.append(pool.apply_async(
+                    _format_block_in_worker, (block,)))
+                # keep every worker busy, but don't let finished blocks pile
+                # up if we can't write them out as fast
+                while len(pending) > 2 * jobs:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
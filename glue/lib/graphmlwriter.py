@@ -0,0 +1,152 @@
+from xml.sax.saxutils import escape
+
+
+GRAPHML_XMLNS = \
+    'xmlns="http://graphml.graphdrawing.org/xmlns" ' \
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
+    'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns ' \
+    'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd"'
+
+# what networkx calls these python types in attr.type
+ATTR_TYPES = {bool: 'boolean', int: 'long', float: 'double', str: 'string'}
+
+
+def _escape_attr(s):
+    return escape(s, {'"': '&quot;', '\n': '&#10;', '\r': '&#13;',
+                      '\t': '&#09;'})
+
+
+def _data(indent, key_id, value):
+    text = escape(str(value))
+    if not text:
+        return '{}<data key="{}" />\n'.format(indent, key_id)
+    return '{}<data key="{}">{}</data>\n'.format(indent, key_id, text)
+
+
+class EdgeFormatter:
+    '''
+    Turns edges into GraphML. It's small and picklable, so worker processes
+    can each format a share of the edges for one GraphMLWriter.
+    '''
+    def __init__(self, node_ids, edge_key_ids, encoding):
+        '''
+        node_ids is the escaped GraphML id of every node, in the order given
+        to GraphMLWriter.write_nodes(). edge_key_ids are the GraphML key ids
+        of the edge attributes.
+        '''
+        self._node_ids = node_ids
+        self._encoding = encoding
+        self._fmt = '    <edge source="{}" target="{}">\n' + ''.join(
+            '      <data key="%s">{}</data>\n' % key_id
+            for key_id in edge_key_ids) + '    </edge>\n'
+
+    def format(self, src_idx, dst_idx, *columns):
+        '''
+        Return the encoded GraphML for the edges between nodes src_idx[k] and
+        dst_idx[k], whose attributes are columns[0][k], columns[1][k], ... in
+        edge_keys order. src_idx and dst_idx are lists of node indices.
+        '''
+        ids = self._node_ids
+        return ''.join(map(
+            self._fmt.format,
+            [ids[s] for s in src_idx], [ids[d] for d in dst_idx], *columns))\
+            .encode(self._encoding)
+
+
+class GraphMLWriter:
+    '''
+    Write an undirected graph as GraphML to the binary file-like fd without
+    ever holding all of its edges. The output is laid out exactly like what
+    networkx.write_graphml() writes for the same graph, so Shadow and anything
+    else reading our topologies can't tell the difference.
+
+    Call write_nodes() once with every node, then write_edges() or
+    write_formatted_edges() as many times as needed, then close(). Edges refer
+    to nodes by their position in the list given to write_nodes().
+    '''
+    def __init__(self, fd, graph_data, edge_keys, encoding='utf-8'):
+        '''
+        graph_data is a dict of graph attributes. edge_keys is a list of
+        (name, python type) for the attributes every edge has, in the order
+        they'll be given to write_edges().
+        '''
+        self._fd = fd
+        self._encoding = encoding
+        self._graph_data = graph_data
+        self._edge_keys = edge_keys
+        self._keys = {}
+        self._edge_formatter = None
+
+    def _write(self, s):
+        self._fd.write(s.encode(self._encoding))
+
+    def _key(self, name, value_type, scope):
+        key = (name, ATTR_TYPES[value_type], scope)
+        if key not in self._keys:
+            self._keys[key] = 'd{}'.format(len(self._keys))
+        return self._keys[key]
+
+    def write_nodes(self, nodes):
+        '''
+        Write the GraphML header and all the nodes. nodes is a list of
+        (node id, dict of attributes).
+        '''
+        assert self._edge_formatter is None
+        # keys are numbered in the order networkx meets them: graph, nodes,
+        # then edges
+        for name, value in self._graph_data.items():
+            self._key(name, type(value), 'graph')
+        for _, data in nodes:
+            for name, value in data.items():
+                self._key(name, type(value), 'node')
+        edge_key_ids = [self._key(name, value_type, 'edge')
+                        for name, value_type in self._edge_keys]
+
+        out = ["<?xml version='1.0' encoding='{}'?>\n".format(self._encoding),
+               '<graphml {}>\n'.format(GRAPHML_XMLNS)]
+        # ... and then listed newest first
+        for (name, attr_type, scope), key_id in reversed(
+                list(self._keys.items())):
+            out.append(
+                '  <key id="{}" for="{}" attr.name="{}" attr.type="{}" />\n'
+                .format(key_id, scope, _escape_attr(name), attr_type))
+        out.append('  <graph edgedefault="undirected">\n')
+        node_ids = []
+        for node, data in nodes:
+            node_id = _escape_attr(str(node))
+            node_ids.append(node_id)
+            if not data:
+                out.append('    <node id="{}" />\n'.format(node_id))
+                continue
+            out.append('    <node id="{}">\n'.format(node_id))
+            for name, value in data.items():
+                out.append(_data(
+                    '      ', self._key(name, type(value), 'node'), value))
+            out.append('    </node>\n')
+        self._write(''.join(out))
+
+        self._edge_formatter = EdgeFormatter(
+            node_ids, edge_key_ids, self._encoding)
+
+    @property
+    def edge_formatter(self):
+        ''' The EdgeFormatter for our edges, once write_nodes() was called. '''
+        assert self._edge_formatter is not None
+        return self._edge_formatter
+
+    def write_edges(self, src_idx, dst_idx, *columns):
+        ''' Write the edges described like in EdgeFormatter.format(). '''
+        self._fd.write(self.edge_formatter.format(src_idx, dst_idx, *columns))
+
+    def write_formatted_edges(self, data):
+        ''' Write edges some EdgeFormatter already formatted. '''
+        assert self._edge_formatter is not None
+        self._fd.write(data)
+
+    def close(self):
+        out = []
+        for name, value in self._graph_data.items():
+            out.append(_data(
+                '    ', self._key(name, type(value), 'graph'), value))
+        out.append('  </graph>\n</graphml>\n')
+        self._write(''.join(out))
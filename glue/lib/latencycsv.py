@@ -0,0 +1,247 @@
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import numpy
+import os
+import traceback
+from array import array
+from multiprocessing import Process, Queue
+
+
+# latency CSV file name extension -> function opening it for reading bytes
+OPENERS = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.bz2': bz2.open,
+}
+
+
+def _open_zstd(fname, mode):
+    # optional, only needed if someone actually has zstd compressed CSVs
+    import zstandard
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+        open(fname, mode), read_across_frames=True, closefd=True))
+
+
+OPENERS['.zst'] = _open_zstd
+
+
+def is_compressed(fname):
+    return os.path.splitext(fname)[1] in OPENERS
+
+
+def open_latency_csv(fname):
+    ''' Open the maybe compressed latency CSV fname for reading bytes. '''
+    return OPENERS.get(os.path.splitext(fname)[1], open)(fname, 'rb')
+
+
+def latency_csv_chunks(fname, offset=0, chunk_rows=1000000):
+    '''
+    Parse the latency CSV fname from byte offset on (in the uncompressed data)
+    and yield one dict per chunk_rows rows with
+
+    - nodes: (ip, city, country, city_name) of every IP first seen in this
+      chunk, whose positions continue where the last chunk's left off,
+    - src, dst: typed arrays of the positions of each row's IPs,
+    - latency: typed array of each row's latency,
+    - msm: typed array of each row's measurement ID, or None if the CSV is
+      from before 05-generate-csv.py wrote them,
+    - offset: the byte offset just after the chunk's last row.
+
+    Only complete rows are read, since the last one could still be being
+    written. Rows are never turned into dicts: each IP is looked up in a dict
+    of positions, and only the first row with an IP we haven't seen yet has
+    its city and country parsed.
+    '''
+    with open_latency_csv(fname) as inf:
+        header = inf.readline()
+        if not header:
+            return
+        offset = max(offset, len(header))
+        if is_compressed(fname):
+            # can't seek in compressed data, so read our way there
+            to_skip = offset - len(header)
+            while to_skip:
+                to_skip -= len(inf.read(min(to_skip, 1024*1024)))
+        else:
+            inf.seek(offset)
+        columns = next(csv.reader([header.decode('utf-8')]))
+        src_col, dst_col, latency_col = [columns.index(name) for name in
+                                         ['src', 'dst', 'latency']]
+        msm_col = columns.index('msm') if 'msm' in columns else None
+        # (ip, city code, city name, country) columns of each end
+        node_cols = {
+            end: [columns.index(end + suffix) for suffix in
+                  ['', '_city', '_city_name', '_country']]
+            for end in ['src', 'dst']}
+
+        def complete_lines():
+            nonlocal offset
+            for line in inf:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                yield line.decode('utf-8')
+
+        def new_chunk():
+            return {'nodes': [], 'src': array('q'), 'dst': array('q'),
+                    'latency': array('d'),
+                    'msm': None if msm_col is None else array('q')}
+
+        node_idx = {}
+        chunk = new_chunk()
+        for row in csv.reader(complete_lines(), delimiter=','):
+            for end, col in [('src', src_col), ('dst', dst_col)]:
+                idx = node_idx.get(row[col])
+                if idx is None:
+                    ip_col, city_col, city_name_col, country_col = \
+                        node_cols[end]
+                    idx = node_idx[row[col]] = len(node_idx)
+                    chunk['nodes'].append((
+                        row[ip_col],
+                        # MaxMind int code, empty if it doesn't know the city
+                        int(row[city_col]) if row[city_col] else None,
+                        row[country_col], row[city_name_col]))
+                chunk[end].append(idx)
+            chunk['latency'].append(float(row[latency_col]))
+            if msm_col is not None:
+                chunk['msm'].append(int(row[msm_col]))
+            if len(chunk['latency']) >= chunk_rows:
+                chunk['offset'] = offset
+                yield chunk
+                chunk = new_chunk()
+        if len(chunk['latency']):
+            chunk['offset'] = offset
+            yield chunk
+
+
+class Deduplicator:
+    '''
+    Remembers the (measurement, src, dst) of every row it let through, to drop
+    the same measurement showing up again, like when two CSVs overlap.
+    '''
+    def __init__(self):
+        # msm id -> sorted array of src << 32 | dst node index codes
+        self._seen = {}
+
+    def filter(self, msm, src, dst):
+        ''' Return a mask of the rows not seen before, and remember them. '''
+        keep = numpy.ones(len(msm), dtype=bool)
+        codes = src << 32 | dst
+        order = numpy.argsort(msm, kind='stable')
+        msm_ids, starts = numpy.unique(msm[order], return_index=True)
+        for msm_id, rows in zip(msm_ids.tolist(),
+                                numpy.split(order, starts[1:])):
+            seen = self._seen.get(msm_id, numpy.zeros(0, dtype=numpy.int64))
+            pos = numpy.searchsorted(seen, codes[rows])
+            pos[pos == len(seen)] = 0
+            dup = seen[pos] == codes[rows] if len(seen) else \
+                numpy.zeros(len(rows), dtype=bool)
+            # and duplicates within this chunk
+            first = numpy.zeros(len(rows), dtype=bool)
+            first[numpy.unique(codes[rows], return_index=True)[1]] = True
+            keep[rows] = first & ~dup
+            self._seen[msm_id] = numpy.union1d(seen, codes[rows])
+        return keep
+
+    def save(self, fname):
+        msm = [numpy.full(len(codes), msm_id, dtype=numpy.int64)
+               for msm_id, codes in self._seen.items()]
+        with open(fname, 'wb') as fd:
+            numpy.savez_compressed(
+                fd, msm=numpy.concatenate([numpy.zeros(0, numpy.int64)] + msm),
+                codes=numpy.concatenate(
+                    [numpy.zeros(0, numpy.int64)] + list(self._seen.values())))
+
+    @staticmethod
+    def load(fname):
+        dedup = Deduplicator()
+        with numpy.load(fname) as npz:
+            msm, codes = npz['msm'], npz['codes']
+        msm_ids, starts = numpy.unique(msm, return_index=True)
+        for msm_id, start, end in zip(
+                msm_ids.tolist(), starts.tolist(),
+                starts[1:].tolist() + [len(msm)]):
+            dedup._seen[msm_id] = codes[start:end]
+        return dedup
+
+
+def _read_chunks_into(queue, fname, offset, chunk_rows):
+    try:
+        for chunk in latency_csv_chunks(fname, offset, chunk_rows):
+            queue.put(chunk)
+        queue.put(None)
+    except BaseException:
+        queue.put(traceback.format_exc())
+
+
+def _chunks_from_process(fname, offset, chunk_rows):
+    '''
+    Start reading fname in another process right away, and return a generator
+    of its chunks. At most a few chunks are read ahead of the generator.
+    '''
+    queue = Queue(maxsize=2)
+    process = Process(target=_read_chunks_into,
+                      args=(queue, fname, offset, chunk_rows), daemon=True)
+    process.start()
+
+    def chunks():
+        try:
+            while True:
+                chunk = queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, str):
+                    raise Exception(
+                        'Reading {} failed:\n{}'.format(fname, chunk))
+                yield chunk
+        finally:
+            process.terminate()
+            process.join()
+    return chunks()
+
+
+def read_latency_csvs(index, inputs, dedup=None, jobs=1,
+                      chunk_rows=1000000):
+    '''
+    Add the rows of many latency CSVs to the unbuilt LatencyIndex index.
+    inputs is a list of (file name, byte offset to start at, weight of its
+    rows). Rows of CSVs with a measurement ID column that dedup (a
+    Deduplicator) already saw are dropped. Return the offsets just after the
+    last complete row of each input, for reading rows appended later.
+
+    With more than one job, up to that many CSVs are parsed at once by other
+    processes. Their rows are still added in the order of inputs, so the
+    index is the same as with one job.
+    '''
+    offsets = []
+    readers = []
+    for i, (fname, offset, weight) in enumerate(inputs):
+        # keep up to jobs readers going, including this input's
+        while jobs > 1 and len(readers) < min(i + jobs, len(inputs)):
+            ahead_fname, ahead_offset, _ = inputs[len(readers)]
+            readers.append(_chunks_from_process(
+                ahead_fname, ahead_offset, chunk_rows))
+        chunks = readers[i] if jobs > 1 else \
+            latency_csv_chunks(fname, offset, chunk_rows)
+        node_idx = numpy.zeros(0, dtype=numpy.int64)
+        for chunk in chunks:
+            node_idx = numpy.concatenate([node_idx, numpy.array(
+                [index.add_node(*node) for node in chunk['nodes']],
+                dtype=numpy.int64)])
+            src = node_idx[numpy.frombuffer(chunk['src'], dtype=numpy.int64)]
+            dst = node_idx[numpy.frombuffer(chunk['dst'], dtype=numpy.int64)]
+            latency = numpy.frombuffer(chunk['latency'])
+            if dedup is not None and chunk['msm'] is not None:
+                keep = dedup.filter(
+                    numpy.frombuffer(chunk['msm'], dtype=numpy.int64),
+                    src, dst)
+                src, dst, latency = src[keep], dst[keep], latency[keep]
+            index.add_samples(src, dst, latency, weight)
+            offset = chunk['offset']
+        offsets.append(offset)
+        if jobs > 1:
+            readers[i] = None
+    return offsets
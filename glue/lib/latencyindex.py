@@ -0,0 +1,569 @@
+import numpy
+import os
+from lib import quantilesketch
+
+
+_EMPTY_SUMS = (numpy.zeros(0, dtype=numpy.int64),
+               numpy.zeros(0, dtype=numpy.float64),
+               numpy.zeros(0, dtype=numpy.float64))
+_EMPTY_SKETCH = (numpy.zeros(0, dtype=numpy.int64),
+                 numpy.zeros(0, dtype=numpy.int64),
+                 numpy.zeros(0, dtype=numpy.float64))
+
+
+def _sum_by_code(codes, counts, sums):
+    '''
+    Merge the counts and sums of equal codes. Returns the sorted unique codes
+    and the total count and sum of each.
+    '''
+    order = numpy.argsort(codes, kind='stable')
+    codes, counts, sums = codes[order], counts[order], sums[order]
+    if not len(codes):
+        return codes, counts, sums
+    codes, starts = numpy.unique(codes, return_index=True)
+    return (codes, numpy.add.reduceat(counts, starts),
+            numpy.add.reduceat(sums, starts))
+
+
+class LatencyIndex:
+    '''
+    Latency samples between probes, collapsed to one value per unordered pair
+    at each level of the ip2ip, city2city, country2country, global hierarchy.
+
+    Feed it nodes with add_node() and arrays of samples between them with
+    add_samples(), call build() once, and then ask it for the latency between
+    two nodes with lookup() or, for many pairs at once, with lookup_pairs(). A
+    built index can be written with save() and read back with
+    LatencyIndex.load() so that the latency CSV only needs to be ingested
+    once.
+
+    Along with the mean, the index keeps the number and sum of the samples for
+    every pair, so a built (or loaded) index can be reopen()ed, fed just the
+    new samples, and built again. changed_pairs() then tells which node pairs
+    that could have changed the latency of.
+    '''
+    LEVELS = ['ip2ip', 'city2city', 'country2country', 'global']
+
+    def __init__(self, statistic='mean', sketch_accuracy=0.01):
+        '''
+        statistic is what every pair's latencies get collapsed to: 'mean',
+        'median', or a percentile like 'p95'. Anything but the mean needs a
+        quantile sketch per pair, whose results are within sketch_accuracy
+        (relative) of the exact statistic.
+        '''
+        self.statistic = statistic
+        self._quantile = quantilesketch.parse_statistic(statistic)
+        self._sketch_accuracy = sketch_accuracy
+        # ip -> (city, country, city_name) of the first row the ip was in
+        self._nodes = {}
+        # node IPs in the order add_node() first saw them, and the reverse
+        self._node_ips = []
+        self._node_idx = {}
+        # until build(), samples are aggregated as soon as they come in, per
+        # pair of ids given out in the order the city or country was first
+        # seen (node indices for ip2ip):
+        # level -> {city or country -> id}, and the other way around
+        self._level_ids = {level: {} for level in LatencyIndex.LEVELS[1:-1]}
+        self._level_values = {level: [] for level in LatencyIndex.LEVELS[1:-1]}
+        # level -> node index -> id, or -1 if the node has no city
+        self._node_level_ids = {
+            level: [] for level in LatencyIndex.LEVELS[1:-1]}
+        # level -> (sorted lo_id << 32 | hi_id pair keys, total weight of the
+        # samples (their number, unless weighted), weighted sum of samples),
+        # and (pair keys, buckets, counts) of the sketches
+        self._acc = {}
+        self._acc_sketch = {}
+        self._built = False
+        # everything below is filled in by build() or load()
+        # level -> list of keys, whose position is that key's id
+        self._keys = {}
+        # level -> node index -> key id, or -1 if the node has no key
+        self._node_key = {}
+        # level -> sorted array of lo_id*num_keys + hi_id pair codes, and the
+        # total weight and weighted sum of the samples, and the latency for
+        # each code. The global level has the one code 0.
+        self._codes = {}
+        self._counts = {}
+        self._sums = {}
+        self._values = {}
+        # level -> (codes, buckets, counts) of the sketches, if not the mean
+        self._sketches = {}
+        self._global = None
+        # what the last build() after reopen() changed, for changed_pairs()
+        self._changed = None
+        # level -> {pair code: latency}, made on first use of lookup()
+        self._lookup = {}
+
+    @staticmethod
+    def _pair(a, b):
+        return (a, b) if a <= b else (b, a)
+
+    def add_node(self, ip, city, country, city_name):
+        '''
+        Remember where ip is, unless an earlier row already told us. Return
+        the node's index, which is what add_samples() takes.
+        '''
+        assert not self._built
+        if ip not in self._nodes:
+            self._nodes[ip] = (city, country, city_name)
+            self._node_idx[ip] = len(self._node_ips)
+            self._node_ips.append(ip)
+            self._intern_node(city, country)
+        return self._node_idx[ip]
+
+    def _intern_node(self, city, country):
+        ''' Give the next node's city and country ids. '''
+        for level, value in [('city2city', city),
+                             ('country2country', country)]:
+            ids = self._level_ids[level]
+            if value is not None and value not in ids:
+                ids[value] = len(ids)
+                self._level_values[level].append(value)
+            self._node_level_ids[level].append(ids.get(value, -1))
+
+    def add_samples(self, src_idx, dst_idx, latency, weight=1.0):
+        '''
+        Fold latency samples between the nodes with the given indices from
+        add_node(), all given as equally long numpy arrays, into the running
+        count, sum, and sketch of each pair at every level. Each sample counts
+        weight times, so the latency of a pair is a weighted statistic if
+        samples come with different weights.
+        '''
+        assert not self._built
+        src_idx = numpy.asarray(src_idx, dtype=numpy.int64)
+        dst_idx = numpy.asarray(dst_idx, dtype=numpy.int64)
+        latency = numpy.asarray(latency, dtype=numpy.float64)
+        for level in LatencyIndex.LEVELS:
+            if level == 'ip2ip':
+                a, b, level_latency = src_idx, dst_idx, latency
+            elif level == 'global':
+                a = b = numpy.zeros(len(latency), dtype=numpy.int64)
+                level_latency = latency
+            else:
+                node_ids = numpy.array(self._node_level_ids[level],
+                                       dtype=numpy.int64)
+                a, b = node_ids[src_idx], node_ids[dst_idx]
+                has_ids = (a >= 0) & (b >= 0)
+                a, b, level_latency = a[has_ids], b[has_ids], \
+                    latency[has_ids]
+            keys = numpy.minimum(a, b) << 32 | numpy.maximum(a, b)
+            weights = numpy.full(len(keys), weight, dtype=numpy.float64)
+            self._acc[level] = _sum_by_code(*[numpy.concatenate(arrays) for
+                                              arrays in zip(
+                self._acc.get(level, _EMPTY_SUMS),
+                (keys, weights, weight * level_latency))])
+            if self._quantile is not None:
+                self._acc_sketch[level] = quantilesketch.collapse(*[
+                    numpy.concatenate(arrays) for arrays in zip(
+                        self._acc_sketch.get(level, _EMPTY_SKETCH),
+                        (keys, quantilesketch.buckets(
+                            level_latency, self._sketch_accuracy),
+                         weights))])
+
+    def build(self):
+        '''
+        Collapse every pair's samples to the statistic. No more add_samples()
+        after this.
+
+        If this index was reopen()ed, the new samples are merged into what it
+        already had.
+        '''
+        assert not self._built
+        reopened = bool(self._codes)
+        changed = {'num_old_nodes': len(self._node_key.get('ip2ip', []))}
+        for level in LatencyIndex.LEVELS:
+            old_keys = self._keys.get(level, [])
+            acc_keys, counts, sums = self._acc.get(level, _EMPTY_SUMS)
+            if level == 'ip2ip':
+                # a copy, since add_node() keeps adding to _node_ips
+                keys = list(self._node_ips)
+                id_pos = numpy.arange(len(keys), dtype=numpy.int64)
+                node_key = id_pos
+            elif level == 'global':
+                keys = ['global']
+                id_pos = numpy.zeros(1, dtype=numpy.int64)
+            else:
+                values = self._level_values[level]
+                sampled = numpy.unique(numpy.concatenate(
+                    [acc_keys >> 32, acc_keys & 0xffffffff]))
+                keys = sorted(set(old_keys) | {
+                    values[i] for i in sampled.tolist()})
+                key_idx = {k: i for i, k in enumerate(keys)}
+                id_pos = numpy.array([key_idx.get(v, -1) for v in values],
+                                     dtype=numpy.int64)
+                node_key = numpy.array([
+                    -1 if i < 0 else id_pos[i]
+                    for i in self._node_level_ids[level]], dtype=numpy.int64)
+            if level != 'global':
+                self._keys[level] = keys
+                self._node_key[level] = node_key
+
+            def to_codes(pair_keys):
+                a = id_pos[pair_keys >> 32]
+                b = id_pos[pair_keys & 0xffffffff]
+                return numpy.minimum(a, b)*len(keys) + numpy.maximum(a, b)
+
+            acc = [_sum_by_code(to_codes(acc_keys), counts, sums)]
+            if self._quantile is not None:
+                sketch_keys, bucket_ids, bucket_counts = \
+                    self._acc_sketch.get(level, _EMPTY_SKETCH)
+                sketch = [quantilesketch.collapse(
+                    to_codes(sketch_keys), bucket_ids, bucket_counts)]
+            if reopened:
+                changed[level] = acc[0][0]
+                remap = self._old_codes(level, old_keys, keys)
+                acc.append((remap(self._codes[level]), self._counts[level],
+                            self._sums[level]))
+                if self._quantile is not None:
+                    old_codes, old_buckets, old_counts = self._sketches[level]
+                    sketch.append(
+                        (remap(old_codes), old_buckets, old_counts))
+            self._codes[level], self._counts[level], self._sums[level] = \
+                _sum_by_code(*[numpy.concatenate(arrays)
+                               for arrays in zip(*acc)])
+            if self._quantile is None:
+                self._values[level] = \
+                    self._sums[level] / self._counts[level]
+            else:
+                self._sketches[level] = quantilesketch.collapse(
+                    *[numpy.concatenate(arrays) for arrays in zip(*sketch)])
+                codes, self._values[level] = quantilesketch.quantiles(
+                    *self._sketches[level], self._quantile,
+                    self._sketch_accuracy)
+                assert numpy.array_equal(codes, self._codes[level])
+            self._lookup.pop(level, None)
+        self._global = float(self._values['global'][0]) \
+            if len(self._values['global']) else None
+        changed['global'] = bool(len(changed.get('global', [])))
+        self._changed = changed if reopened else None
+        self._acc, self._acc_sketch = {}, {}
+        self._built = True
+
+    def _old_codes(self, level, old_keys, keys):
+        '''
+        Return a function that turns the codes a level had before reopen()
+        into codes in its new key space.
+        '''
+        if level == 'global':
+            return lambda codes: numpy.asarray(codes)
+        key_idx = {k: i for i, k in enumerate(keys)}
+        old_ids = numpy.array([key_idx[k] for k in old_keys],
+                              dtype=numpy.int64)
+
+        def remap(codes):
+            codes = numpy.asarray(codes)
+            if not len(old_keys):
+                return codes
+            a = old_ids[codes // len(old_keys)]
+            b = old_ids[codes % len(old_keys)]
+            return numpy.minimum(a, b)*len(keys) + numpy.maximum(a, b)
+        return remap
+
+    def reopen(self):
+        '''
+        Go back to accepting add_node() and add_samples() after build(),
+        keeping all the samples we already have.
+        '''
+        assert self._built
+        assert all(level in self._counts for level in LatencyIndex.LEVELS), \
+            'This index was saved without sample counts and can\'t be reopened'
+        self._changed = None
+        self._built = False
+
+    def changed_pairs(self):
+        '''
+        Return (lo, hi) arrays of the node indices, where lo <= hi, of every
+        pair of nodes whose lookup() could have changed in the last build()
+        after reopen(): pairs with a new node, and pairs whose ip2ip, city,
+        or country pair got new samples. If the global latency changed, also
+        every pair whose countries were never measured against each other.
+        '''
+        assert self._built and self._changed is not None
+        num_nodes = len(self._node_ips)
+        nodes = numpy.arange(num_nodes)
+        new_nodes = numpy.arange(self._changed['num_old_nodes'], num_nodes)
+        src = [numpy.repeat(nodes, len(new_nodes))]
+        dst = [numpy.tile(new_nodes, num_nodes)]
+        for level in LatencyIndex.LEVELS[:-1]:
+            num_keys = len(self._keys[level])
+            a = self._changed[level] // max(num_keys, 1)
+            b = self._changed[level] % max(num_keys, 1)
+            if level == 'ip2ip':
+                src.append(a)
+                dst.append(b)
+                continue
+            level_src, level_dst = self._nodes_between(level, a, b)
+            src.extend(level_src)
+            dst.extend(level_dst)
+        if self._changed['global']:
+            level = 'country2country'
+            num_keys = len(self._keys[level])
+            countries = numpy.unique(self._node_key[level])
+            countries = countries[countries >= 0]
+            a = numpy.repeat(countries, len(countries))
+            b = numpy.tile(countries, len(countries))
+            codes = numpy.setdiff1d(a[a <= b]*num_keys + b[a <= b],
+                                    self._codes[level])
+            level_src, level_dst = self._nodes_between(
+                level, codes // max(num_keys, 1), codes % max(num_keys, 1))
+            src.extend(level_src)
+            dst.extend(level_dst)
+        src, dst = numpy.concatenate(src), numpy.concatenate(dst)
+        codes = numpy.unique(
+            numpy.minimum(src, dst)*num_nodes + numpy.maximum(src, dst))
+        return codes // num_nodes, codes % num_nodes
+
+    def _nodes_between(self, level, a, b):
+        '''
+        Return lists of (src, dst) arrays of node indices, together making up
+        every pair of a node with key a[k] and a node with key b[k].
+        '''
+        node_key = self._node_key[level]
+        order = numpy.argsort(node_key, kind='stable')
+        bounds = numpy.searchsorted(
+            node_key[order], numpy.arange(len(self._keys[level]) + 1))
+        src, dst = [], []
+        for x, y in zip(a.tolist(), b.tolist()):
+            nodes_x = order[bounds[x]:bounds[x + 1]]
+            nodes_y = order[bounds[y]:bounds[y + 1]]
+            src.append(numpy.repeat(nodes_x, len(nodes_y)))
+            dst.append(numpy.tile(nodes_y, len(nodes_x)))
+        return src, dst
+
+    def collapsed(self, level):
+        '''
+        Return an index with one node per city (level 'city2city') or country
+        ('country2country') instead of one per IP, and an array with the
+        position in it of each of our nodes. In the city index, nodes without
+        a city get one node per country.
+
+        Each collapsed node is named after the first IP seen in its city or
+        country and has no ip2ip latencies, so lookups in it start at the
+        city (or country) level. It shares all other arrays with this index.
+        '''
+        assert self._built and level in ['city2city', 'country2country']
+        groups = {}
+        node_map = []
+        for ip in self._node_ips:
+            city, country, _ = self._nodes[ip]
+            if level == 'country2country' or city is None:
+                group = (None, country)
+            else:
+                group = (city, None)
+            node_map.append(groups.setdefault(group, len(groups)))
+        node_map = numpy.array(node_map, dtype=numpy.int64)
+        # first node of each group
+        reps = numpy.unique(node_map, return_index=True)[1]
+
+        index = LatencyIndex(self.statistic, self._sketch_accuracy)
+        index._node_ips = [self._node_ips[i] for i in reps.tolist()]
+        index._node_idx = {ip: i for i, ip in enumerate(index._node_ips)}
+        for ip in index._node_ips:
+            city, country, city_name = self._nodes[ip]
+            if level == 'country2country':
+                city, city_name = None, None
+            index._nodes[ip] = (city, country, city_name)
+        index._keys = {
+            'ip2ip': list(index._node_ips),
+            'city2city': self._keys['city2city'],
+            'country2country': self._keys['country2country'],
+        }
+        index._node_key = {
+            'ip2ip': numpy.arange(len(reps), dtype=numpy.int64),
+            'city2city': numpy.full(len(reps), -1, dtype=numpy.int64)
+            if level == 'country2country'
+            else self._node_key['city2city'][reps],
+            'country2country': self._node_key['country2country'][reps],
+        }
+        for name in LatencyIndex.LEVELS:
+            if name == 'ip2ip':
+                index._codes[name], index._counts[name], \
+                    index._sums[name] = _EMPTY_SUMS
+                index._values[name] = numpy.zeros(0)
+                if self._quantile is not None:
+                    index._sketches[name] = _EMPTY_SKETCH
+                continue
+            index._codes[name] = self._codes[name]
+            index._counts[name] = self._counts[name]
+            index._sums[name] = self._sums[name]
+            index._values[name] = self._values[name]
+            if name in self._sketches:
+                index._sketches[name] = self._sketches[name]
+        index._global = self._global
+        index._built = True
+        return index, node_map
+
+    @property
+    def nodes(self):
+        ''' List of node IPs, in the order they were first seen. '''
+        assert self._built
+        return self._node_ips
+
+    def node_info(self, ip):
+        ''' Return the (city, country, city_name) of the given node IP. '''
+        return self._nodes[ip]
+
+    def measured_pairs(self):
+        '''
+        Return (lo, hi) arrays of the node indices of every pair of nodes with
+        a direct ip2ip measurement, where lo <= hi.
+        '''
+        assert self._built
+        codes = numpy.asarray(self._codes['ip2ip'])
+        return codes // len(self._node_ips), codes % len(self._node_ips)
+
+    def lookup(self, src, dst):
+        '''
+        Return the latency between the src and dst node IPs from the most
+        specific level of the hierarchy that has a measurement for them.
+        '''
+        assert self._built
+        s, d = self._node_idx[src], self._node_idx[dst]
+        for level in LatencyIndex.LEVELS[:-1]:
+            a, b = self._node_key[level][s], self._node_key[level][d]
+            if a < 0 or b < 0:
+                continue
+            if level not in self._lookup:
+                self._lookup[level] = dict(zip(
+                    self._codes[level].tolist(),
+                    self._values[level].tolist()))
+            a, b = LatencyIndex._pair(int(a), int(b))
+            code = a*len(self._keys[level]) + b
+            if code in self._lookup[level]:
+                return self._lookup[level][code]
+        return self._global
+
+    def lookup_pairs(self, src_idx, dst_idx):
+        '''
+        Vectorized lookup(): return an array with the latency between each
+        src_idx[k], dst_idx[k] pair of node indices (positions in nodes).
+        '''
+        assert self._built
+        latency = numpy.full(len(src_idx), numpy.nan)
+        for level in LatencyIndex.LEVELS[:-1]:
+            missing = numpy.flatnonzero(numpy.isnan(latency))
+            if not len(missing) or not len(self._codes[level]):
+                continue
+            a = self._node_key[level][src_idx[missing]]
+            b = self._node_key[level][dst_idx[missing]]
+            have_keys = (a >= 0) & (b >= 0)
+            missing, a, b = missing[have_keys], a[have_keys], b[have_keys]
+            codes = numpy.minimum(a, b)*len(self._keys[level]) + \
+                numpy.maximum(a, b)
+            pos = numpy.searchsorted(self._codes[level], codes)
+            pos[pos == len(self._codes[level])] = 0
+            found = self._codes[level][pos] == codes
+            latency[missing[found]] = self._values[level][pos[found]]
+        if self._global is not None:
+            latency[numpy.isnan(latency)] = self._global
+        return latency
+
+    def _arrays(self):
+        ''' Return a dict of named numpy arrays that make up this index. '''
+        assert self._built
+        arrays = {
+            'node_ip': numpy.array(self._node_ips, dtype=str),
+            'node_city': numpy.array(
+                [-1 if self._nodes[ip][0] is None else self._nodes[ip][0]
+                 for ip in self._node_ips], dtype=numpy.int64),
+            'node_country': numpy.array(
+                [self._nodes[ip][1] for ip in self._node_ips], dtype=str),
+            'node_city_name': numpy.array(
+                ['' if self._nodes[ip][2] is None else self._nodes[ip][2]
+                 for ip in self._node_ips], dtype=str),
+            'global': numpy.array(
+                [numpy.nan if self._global is None else self._global]),
+            'statistic': numpy.array(self.statistic),
+            'sketch_accuracy': numpy.array([self._sketch_accuracy]),
+            'city2city_keys': numpy.array(
+                self._keys['city2city'], dtype=numpy.int64),
+            'country2country_keys': numpy.array(
+                self._keys['country2country'], dtype=str),
+        }
+        for level in LatencyIndex.LEVELS:
+            if level != 'global':
+                arrays[level + '_node_key'] = self._node_key[level]
+            arrays[level + '_codes'] = self._codes[level]
+            arrays[level + '_counts'] = self._counts[level]
+            arrays[level + '_sums'] = self._sums[level]
+            arrays[level + '_values'] = self._values[level]
+            if level in self._sketches:
+                for name, array in zip(['codes', 'buckets', 'counts'],
+                                       self._sketches[level]):
+                    arrays['{}_sketch_{}'.format(level, name)] = array
+        return arrays
+
+    @staticmethod
+    def _from_arrays(arrays):
+        # indexes saved before there was a choice are means
+        index = LatencyIndex(
+            str(arrays['statistic']) if 'statistic' in arrays else 'mean',
+            float(arrays['sketch_accuracy'][0])
+            if 'sketch_accuracy' in arrays else 0.01)
+        node_ips = arrays['node_ip'].tolist()
+        node_city = [None if c < 0 else c
+                     for c in arrays['node_city'].tolist()]
+        node_country = arrays['node_country'].tolist()
+        node_city_name = arrays['node_city_name'].tolist()
+        index._nodes = {
+            ip: (city, country, city_name) for ip, city, country, city_name
+            in zip(node_ips, node_city, node_country, node_city_name)}
+        index._node_ips = node_ips
+        index._node_idx = {ip: i for i, ip in enumerate(node_ips)}
+        for city, country in zip(node_city, node_country):
+            index._intern_node(city, country)
+        index._keys = {
+            'ip2ip': list(node_ips),
+            'city2city': arrays['city2city_keys'].tolist(),
+            'country2country': arrays['country2country_keys'].tolist(),
+        }
+        for level in LatencyIndex.LEVELS:
+            if level != 'global':
+                index._node_key[level] = arrays[level + '_node_key']
+            # the global level only has its value in indexes saved before
+            # we kept the number and sum of samples, which can't be reopened
+            if level + '_codes' in arrays:
+                index._codes[level] = arrays[level + '_codes']
+                index._values[level] = arrays[level + '_values']
+            if level + '_counts' in arrays:
+                index._counts[level] = arrays[level + '_counts']
+                index._sums[level] = arrays[level + '_sums']
+            if level + '_sketch_codes' in arrays:
+                index._sketches[level] = tuple(
+                    arrays['{}_sketch_{}'.format(level, name)]
+                    for name in ['codes', 'buckets', 'counts'])
+        global_latency = float(arrays['global'][0])
+        index._global = None if numpy.isnan(global_latency) \
+            else global_latency
+        index._built = True
+        return index
+
+    def save(self, fname):
+        with open(fname, 'wb') as fd:
+            numpy.savez_compressed(fd, **self._arrays())
+
+    @staticmethod
+    def load(fname):
+        with numpy.load(fname, allow_pickle=False) as npz:
+            return LatencyIndex._from_arrays({name: npz[name] for name in npz})
+
+    def share(self, dname):
+        '''
+        Save this index as one uncompressed .npy file per array in the
+        existing directory dname, for other processes to attach() to.
+        '''
+        for name, array in self._arrays().items():
+            numpy.save(os.path.join(dname, name + '.npy'), array)
+
+    @staticmethod
+    def attach(dname):
+        '''
+        Load an index written with share(). Its arrays are memory mapped, so
+        any number of processes can attach to the same index while the OS
+        keeps only one copy of it in memory.
+        '''
+        return LatencyIndex._from_arrays({
+            os.path.splitext(fname)[0]: numpy.load(
+                os.path.join(dname, fname), mmap_mode='r',
+                allow_pickle=False)
+            for fname in os.listdir(dname) if fname.endswith('.npy')})
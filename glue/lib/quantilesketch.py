@@ -0,0 +1,74 @@
+import math
+import numpy
+
+
+# smallest latency a sketch tells apart from the next bigger ones, in ms
+MIN_LATENCY = 1e-3
+
+
+def parse_statistic(statistic):
+    '''
+    Return the quantile (0 to 1) the given statistic asks for: 'median' or
+    'pNN' like 'p95' or 'p99.9'. Return None for 'mean', which needs no
+    sketch. Raise ValueError for anything else.
+    '''
+    if statistic == 'mean':
+        return None
+    if statistic == 'median':
+        return 0.5
+    if statistic.startswith('p'):
+        q = float(statistic[1:]) / 100
+        if 0 <= q <= 1:
+            return q
+    raise ValueError('Unknown statistic {}'.format(statistic))
+
+
+def _gamma(accuracy):
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def buckets(latency, accuracy):
+    '''
+    Return the sketch bucket of each latency. Every latency in a bucket is
+    within accuracy (relative) of the value quantiles() reports for it, like
+    in DDSketch.
+    '''
+    latency = numpy.maximum(latency, MIN_LATENCY)
+    return numpy.ceil(
+        numpy.log(latency) / math.log(_gamma(accuracy))).astype(numpy.int64)
+
+
+def collapse(codes, bucket_ids, counts):
+    '''
+    Merge the counts (or weights) of equal (code, bucket) entries. Returns the
+    entries sorted by code and then bucket, so that sketches of any number of
+    pairs can be merged by concatenating them and calling this again.
+    '''
+    order = numpy.lexsort((bucket_ids, codes))
+    codes, bucket_ids, counts = codes[order], bucket_ids[order], counts[order]
+    if not len(codes):
+        return codes, bucket_ids, counts
+    starts = numpy.flatnonzero(numpy.concatenate([
+        [True], (codes[1:] != codes[:-1]) | (bucket_ids[1:] != bucket_ids[:-1])
+    ]))
+    return (codes[starts], bucket_ids[starts],
+            numpy.add.reduceat(counts, starts))
+
+
+def quantiles(codes, bucket_ids, counts, q, accuracy):
+    '''
+    Return the unique codes of collapse()d sketches, and the q quantile of
+    the latencies of each.
+    '''
+    if not len(codes):
+        return codes, numpy.zeros(0)
+    cum = numpy.cumsum(counts)
+    starts = numpy.flatnonzero(numpy.concatenate(
+        [[True], codes[1:] != codes[:-1]]))
+    ends = numpy.concatenate([starts[1:], [len(codes)]])
+    before = cum[starts] - counts[starts]
+    total = cum[ends - 1] - before
+    # the first bucket whose running count passes the rank of the quantile
+    pos = numpy.searchsorted(cum, before + q*(total - 1), side='right')
+    gamma = _gamma(accuracy)
+    return codes[starts], 2 * gamma**bucket_ids[pos] / (gamma + 1)
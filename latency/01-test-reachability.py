@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from lib.campaignstore import CampaignStore
 from lib.pastlylogger import PastlyLogger
+from lib.georesolver import GeoResolver
 from lib.probelist import ProbeList
 from lib.resultsmanager import ResultsManager
 from lib.atlasclient import AtlasClient
 from lib.periodicevent import PeriodicEvent
 import os
-import maxminddb
 import time
 import json
 from queue import Empty, Queue
@@ -132,25 +133,37 @@ probably_can_create_measurement.last_answer = None
 def main(args):
     global progress
     global progress_end
-    mmdb = maxminddb.open_database(args.mmdb)
-    probe_list = ProbeList(args, log, mmdb)
-    results_manager = ResultsManager(args, log)
-    atlas_client = AtlasClient(args, log, results_manager)
-    workers = [Worker(args, log, results_manager, kill_worker_threads,
-                      'Worker-{}'.format(i)) for i in range(0, args.threads)]
-    pe = PeriodicEvent(log_stats, _run_interval=args.stats_interval,
-                       _end_event=kill_stats_thread, _thread_name='stats')
-    progress = 0 - previously_existing_progress
-    progress_end = probe_list.num_probes_with_a_city - previously_existing_progress
-    for probe in probe_list.probes_with_a_city:
-        while not probably_can_create_measurement(args):
-            time.sleep(15)
-        progress += 1
-        worker = get_next_worker_thread(workers)
-        log.debug('Giving worker', worker.name, 'probe', probe['id'])
-        worker.give({'probe': probe})
-    kill_worker_threads.set()
-    kill_stats_thread.set()
+    geo = GeoResolver(args.mmdb, args.geo_cache, log)
+    db = CampaignStore(args.campaign_db, log) if args.campaign_db else None
+    probe_list = ProbeList(args, log, geo, db)
+    results_manager = ResultsManager(args, log, db)
+    workers = []
+    try:
+        atlas_client = AtlasClient(args, log, results_manager)
+        workers = [Worker(args, log, results_manager, kill_worker_threads,
+                          'Worker-{}'.format(i))
+                   for i in range(0, args.threads)]
+        pe = PeriodicEvent(log_stats, _run_interval=args.stats_interval,
+                           _end_event=kill_stats_thread, _thread_name='stats')
+        progress = 0 - previously_existing_progress
+        progress_end = probe_list.num_probes_with_a_city - previously_existing_progress
+        # every probe has been resolved by now
+        geo.save()
+        for probe in probe_list.probes_with_a_city:
+            while not probably_can_create_measurement(args):
+                time.sleep(15)
+            progress += 1
+            worker = get_next_worker_thread(workers)
+            log.debug('Giving worker', worker.name, 'probe', probe['id'])
+            worker.give({'probe': probe})
+    finally:
+        # let the workers hand in what they're waiting on before the last
+        # checkpoint
+        kill_worker_threads.set()
+        for worker in workers:
+            worker.wait()
+        kill_stats_thread.set()
+        results_manager.close()
 
 
 if __name__ == '__main__':
@@ -164,9 +177,24 @@ if __name__ == '__main__':
     parser.add_argument(
         '--mmdb', type=str, default='data/GeoLite2-City.mmdb', help='Path to '
         'MaxMind City DB')
+    parser.add_argument(
+        '--geo-cache', type=str, default='cache/geo-cache.json',
+        help='File in which to cache where IPs are according to --mmdb, '
+        'shared by all the scripts')
     parser.add_argument(
         '--measurements-file', type=str, default='cache/reachability-measurements.json',
         help='File to store measurement IDs as they are created')
+    parser.add_argument(
+        '--checkpoint-interval', type=float, default=60, help='Append new '
+        'measurements and results to a log next to --measurements-file every '
+        'this many seconds')
+    parser.add_argument(
+        '--checkpoint-records', type=int, default=50, help='Or as soon as '
+        'there are this many of them')
+    parser.add_argument(
+        '--campaign-db', type=str, metavar='FNAME',
+        help='Also keep probes, measurements and results in this SQLite '
+        'database shared by all the scripts')
     parser.add_argument(
         '--src-probe', type=int, default=33415, help='ID of source RIPE Atlas '
         'probe to use to test reachability of other probes')
@@ -194,6 +222,9 @@ if __name__ == '__main__':
         fail_hard(args.mmdb, 'must exist as a file')
     if len(args.api) != 36:
         fail_hard(args.api, 'doesn\'t look like an API key')
+    if args.checkpoint_interval <= 0 or args.checkpoint_records < 1:
+        fail_hard('--checkpoint-interval and --checkpoint-records must be '
+                  'positive')
     try:
         main(args)
     except KeyboardInterrupt: pass
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from lib.campaignstore import CampaignStore
 from lib.pastlylogger import PastlyLogger
+from lib.georesolver import GeoResolver
 from lib.probelist import ProbeList
-import maxminddb
 import os
 log = PastlyLogger(debug='/dev/stdout', overwrite=['debug'], log_threads=True)
 #log = PastlyLogger(info='/dev/stdout', overwrite=['info'], log_threads=True)
@@ -13,14 +14,17 @@ def fail_hard(*s):
 
 
 def main(args):
-    mmdb = maxminddb.open_database(args.mmdb)
-    probe_list = ProbeList(args, log, mmdb)
+    geo = GeoResolver(args.mmdb, args.geo_cache, log)
+    db = CampaignStore(args.campaign_db, log, readonly=True) \
+        if args.campaign_db else None
+    probe_list = ProbeList(args, log, geo, db)
     probe_list.add_reachability_info()
     probe_list.trim_unreachable()
     probe_list.group_probes_by_city()
     probe_list.keep_only_best()
     probe_list.assert_all_probes_have_city()
     probe_list.generate_all_pairs()
+    geo.save()
 
 
 if __name__ == '__main__':
@@ -34,9 +38,17 @@ if __name__ == '__main__':
     parser.add_argument(
         '--measurements-file', type=str, default='cache/reachability-measurements.json',
         help='File with reachability measurements from 01-test-reachability.py')
+    parser.add_argument(
+        '--campaign-db', type=str, metavar='FNAME',
+        help='Get reachability results from this SQLite database 01 wrote to '
+        'instead of --measurements-file')
     parser.add_argument(
         '--mmdb', type=str, default='data/GeoLite2-City.mmdb', help='Path to '
         'MaxMind City DB')
+    parser.add_argument(
+        '--geo-cache', type=str, default='cache/geo-cache.json',
+        help='File in which to cache where IPs are according to --mmdb, '
+        'shared by all the scripts')
     parser.add_argument(
         '--out-selected-probes', type=str, default='data/selected-probes.json',
         help='File to store the best probes for future scripts')
@@ -48,6 +60,7 @@ if __name__ == '__main__':
         '--max-probes-per-measurement', type=int, default=950,
         help='Max number of source probes that can be used in a measurement')
     args = parser.parse_args()
-    for fname in [args.measurements_file, args.mmdb, args.probe_list]:
+    for fname in [args.campaign_db or args.measurements_file, args.mmdb,
+                  args.probe_list]:
         if not os.path.isfile(fname): fail_hard(fname, 'must exist as a file')
     exit(main(args))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from lib.campaignstore import CampaignStore
 from lib.pastlylogger import PastlyLogger
 from lib.periodicevent import PeriodicEvent
 from lib.atlasclient03 import AtlasClient
 from lib.resultsmanager03 import ResultsManager
+from array import array
 from threading import Thread, Event
 from queue import Empty, Queue
 import time, os, json
@@ -24,6 +26,8 @@ start_time = time.time()
 progress = None
 progress_end = None
 workers = []
+results_manager = None
+db = None
 
 class Worker:
     def __init__(self, args, log, results_manager, end_event, name):
@@ -62,9 +66,13 @@ class Worker:
         log('Ending Worker', self._name)
 
 class InMeasurement:
+    # there's one of these per line of --measurement-list, each with hundreds
+    # of probes, so keep them small
+    __slots__ = ('_target', '_probes')
+
     def __init__(self, target_ip, probe_ids):
         self._target = target_ip
-        self._probes = [int(p) for p in probe_ids]
+        self._probes = array('I', (int(p) for p in probe_ids))
     @property
     def target(self): return self._target
     @property
@@ -159,11 +167,14 @@ def main(args):
     global workers
     global progress
     global progress_end
+    global results_manager
+    global db
     in_measurements = read_in_measurements(args)
     stats_thread = PeriodicEvent(
         log_stats, _run_interval=args.stats_interval,
         _end_event=kill_stats_thread, _thread_name='stats')
-    results_manager = ResultsManager(args, log, kill_results_thread)
+    db = CampaignStore(args.campaign_db, log) if args.campaign_db else None
+    results_manager = ResultsManager(args, log, kill_results_thread, db)
     workers = [ Worker(args, log, results_manager, kill_worker_threads, 'worker-{}'.format(i))
                for i in range(0, args.threads) ]
     progress = 0
@@ -201,6 +212,10 @@ if __name__ == '__main__':
         help='Maximum results RIPE will let you get per day')
     parser.add_argument('--all-pairs-measurements', type=str, default='cache/all-pairs-measurements.txt',
         help='Place to cache list of measurements we\'ve made')
+    parser.add_argument(
+        '--campaign-db', type=str, metavar='FNAME',
+        help='Also add measurements to this SQLite database shared by all the '
+        'scripts')
     parser.add_argument(
         '--stats-interval', type=float, default=300, help='Log progress stats '
         'every this many seconds')
@@ -217,5 +232,10 @@ if __name__ == '__main__':
             worker.wait()
         kill_results_thread.set()
         kill_stats_thread.set()
+        # only once the results thread made its last write to it durable
+        if results_manager is not None:
+            results_manager.wait()
+        if db is not None:
+            db.close()
 
 
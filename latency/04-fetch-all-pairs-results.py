@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from lib.campaignstore import CampaignStore, STAGE_ALL_PAIRS
 from lib.pastlylogger import PastlyLogger
-from ripe.atlas.cousteau import AtlasLatestRequest
+from lib.resultfetcher import ResultFetcher
+from lib.resultsstore import ResultsStore, is_results_store, project_result
+from lib.resultsstream import iter_results
+from itertools import groupby
 import os
-import json
-import time
 log = PastlyLogger(debug='/dev/stdout', overwrite=['debug'], log_threads=True)
 #log = PastlyLogger(info='/dev/stdout', overwrite=['info'], log_threads=True)
 #log = PastlyLogger(notice='/dev/stdout', overwrite=['notice'], log_threads=True)
@@ -19,6 +21,9 @@ def load_all_msm_ids(args):
     msm_ids = set()
     with open(args.measurements, 'rt') as fd:
         for line in fd:
+            # 03 is appending this line right now
+            if not line.endswith('\n'):
+                break
             words = line.strip().split()
             msm_ids.add(str(words[0]))
     log.info('Found', len(msm_ids), 'measurements in', args.measurements)
@@ -26,56 +31,71 @@ def load_all_msm_ids(args):
     return
 
 
-def load_existing_results(args):
-    results = {}
-    if not os.path.isfile(args.results):
-        return results
-    with open(args.results, 'rt') as fd:
-        results = json.load(fd)
-    log.info('Found', len(results), 'existing results in', args.results)
-    return results
+def store_results(args, stores, msm_id, results):
+    '''
+    Add the raw results of msm_id to the stores: (results store, raw archive
+    or None, CampaignStore or None).
+    '''
+    store, archive, db = stores
+    if archive is not None:
+        archive.add(msm_id, results)
+    stored = results
+    if not args.no_projection:
+        stored = [project_result(result) for result in results]
+    store.add(msm_id, stored)
+    if db is not None:
+        db.add_results(msm_id, [(result['prb_id'], s)
+                                for result, s in zip(results, stored)])
+        db.commit()
 
 
-def write_results(args, results):
-    log.info('Writing resutls to', args.results)
-    with open(args.results, 'wt') as fd:
-        json.dump(results, fd, indent=2)
-
-
-def fetch_result_for_msm(msm_id):
-    req = AtlasLatestRequest(msm_id=msm_id)
-    log.debug('Fetching result for', msm_id)
-    success, resp = req.create()
-    if not success:
-        log.warn('Issue fetching results for msm', msm_id, ':', resp)
-        return None
-    return resp
+def import_json_results(args, stores):
+    ''' Add the measurements in the JSON file 04 used to write to stores '''
+    log.info('Importing results from', args.import_json)
+    count = 0
+    for msm_id, results in groupby(iter_results(args.import_json, log),
+                                   key=lambda item: item[0]):
+        if msm_id in stores[0]:
+            continue
+        store_results(args, stores, msm_id, [result for _, result in results])
+        count += 1
+    log.info('Imported', count, 'measurements')
 
 
 def main(args):
     msm_ids = load_all_msm_ids(args)
-    results = load_existing_results(args)
-    count = 0
-    need_write = False
+    stores = (ResultsStore(args.results, log, writable=True),
+              ResultsStore(args.raw_archive, log, writable=True)
+              if args.raw_archive else None,
+              CampaignStore(args.campaign_db, log)
+              if args.campaign_db else None)
+    store, _, db = stores
+    if db is not None:
+        # like those of another 03 that only told the database
+        msm_ids = sorted(set(msm_ids) | {
+            str(msm_id) for msm_id in db.msm_ids(STAGE_ALL_PAIRS)})
+    log.info('Found', len(store), 'existing results in', args.results)
     try:
-        for msm_id in sorted(msm_ids):
-            if msm_id not in results:
-                res = fetch_result_for_msm(msm_id)
-                time.sleep(0.25)
-                if not res: continue
-                results[msm_id] = res
-                need_write = True
-                count += 1
-                if count >= args.write_results_every:
-                    count = 0
-                    write_results(args, results)
-                    need_write = False
-            #else:
-            #    log.debug('Already had result for', msm_id)
+        if args.import_json:
+            import_json_results(args, stores)
+        if args.compact:
+            for s in stores[:2]:
+                if s is not None:
+                    s.compact()
+            return
+        todo = [msm_id for msm_id in sorted(msm_ids) if msm_id not in store]
+        log.info('Fetching', len(todo), 'results with', args.threads,
+                 'threads')
+        fetcher = ResultFetcher(args, log)
+        # results come back in msm_id order, like when fetching one by one,
+        # and each is on disk as soon as it's here
+        for msm_id, res in fetcher.fetch_all(todo):
+            if not res: continue
+            store_results(args, stores, msm_id, res)
     finally:
-        if need_write:
-            write_results(args, results)
-            need_write = False
+        for s in stores:
+            if s is not None:
+                s.close()
 
 
 if __name__ == '__main__':
@@ -84,14 +104,63 @@ if __name__ == '__main__':
         '--measurements', type=str, default='cache/all-pairs-measurements.txt',
         help='Output from 03-all-pairs-ping.py')
     parser.add_argument(
-        '--results', type=str, default='cache/all-pairs-results.json',
-        help='Place to store fetched results from RIPE')
+        '--results', type=str, default='cache/all-pairs-results.jsonl',
+        help='Place to store fetched results from RIPE, one measurement per '
+        'line. Gzip compressed if it ends in .gz, like '
+        'all-pairs-results.jsonl.gz')
+    parser.add_argument(
+        '--no-projection', action='store_true',
+        help='Store results in --results exactly as RIPE gives them, instead '
+        'of just the IPs and RTTs 05-generate-csv.py needs')
+    parser.add_argument(
+        '--raw-archive', type=str, metavar='FNAME',
+        help='Also store results exactly as RIPE gives them in this file '
+        '(.jsonl or .jsonl.gz), like for audits')
+    parser.add_argument(
+        '--campaign-db', type=str, metavar='FNAME',
+        help='Also store results in this SQLite database shared by all the '
+        'scripts, and fetch the measurements 03 added to it too')
+    parser.add_argument(
+        '--import-json', type=str, metavar='FNAME',
+        help='Add the results in the JSON file older versions of this script '
+        'wrote (cache/all-pairs-results.json) to --results first')
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='Drop results superseded by newer ones for the same measurement '
+        'from --results, and exit without fetching anything')
+    parser.add_argument(
+        '--threads', type=int, default=4,
+        help='Num of results to fetch at once')
+    parser.add_argument(
+        '--rate', type=float, default=4, help='Max num of requests per second '
+        'to make to RIPE, including retries')
+    parser.add_argument(
+        '--burst', type=int, default=4, help='Num of requests that can be '
+        'made at once after a pause without going over --rate')
+    parser.add_argument(
+        '--retries', type=int, default=5, help='Num of times to try again to '
+        'fetch a result after a gateway error or timeout')
+    parser.add_argument(
+        '--backoff', type=float, default=2, help='Wait up to this many '
+        'seconds before the first retry, doubling for every one after')
+    parser.add_argument(
+        '--timeout', type=float, default=60, help='Seconds to wait for RIPE '
+        'to answer a request')
     parser.add_argument(
-        '--write-results-every', type=int, default=5, metavar='NUM',
-        help='Write out all fetched-so-far results every NUM fetches')
+        '--api-url', type=str, default='https://atlas.ripe.net',
+        help='RIPE Atlas API to fetch from, like a local stand-in for testing')
     args = parser.parse_args()
-    for fname in [args.measurements]:
+    if args.threads < 1 or args.rate <= 0 or args.burst < 1 or \
+            args.retries < 0:
+        fail_hard('--threads, --rate, --burst need to be positive and '
+                  '--retries can\'t be negative')
+    for fname in [args.measurements] + \
+            ([args.import_json] if args.import_json else []):
         if not os.path.isfile(fname):
             fail_hard(fname, 'must exist')
+    for fname in [args.results] + \
+            ([args.raw_archive] if args.raw_archive else []):
+        if not is_results_store(fname):
+            fail_hard(fname, 'must end in .jsonl or .jsonl.gz')
     try: main(args)
     except KeyboardInterrupt: pass
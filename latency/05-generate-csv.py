@@ -1,18 +1,23 @@
 #!/usr/bin/env python3
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from lib.georesolver import GeoResolver
 from lib.pastlylogger import PastlyLogger
-from functools import lru_cache
-from statistics import median
-import maxminddb
+from lib.resultsstore import project_result
+from lib.resultsstream import iter_results
+from collections import deque
+from multiprocessing import Pool
+import hashlib
+import io
+import json
+import numpy
 import os
 import csv
-import json
 
 
 log = PastlyLogger(debug='/dev/stdout', overwrite=['debug'], log_threads=True)
 #log = PastlyLogger(info='/dev/stdout', overwrite=['info'], log_threads=True)
 #log = PastlyLogger(notice='/dev/stdout', overwrite=['notice'], log_threads=True)
-mmdb = None
+geo = None
 
 
 def fail_hard(*s):
@@ -20,86 +25,290 @@ def fail_hard(*s):
     exit(1)
 
 
-def load_results(args):
-    log('loading results from', args.results)
-    with open(args.results, 'rt') as fd:
-        return json.load(fd)
+# columns added by --rtt-stats, all but packetloss in ms of round trip time
+RTT_STATS_FIELDS = ['min_rtt', 'median_rtt', 'mean_rtt', 'p95_rtt',
+                    'packetloss']
 
 
-@lru_cache(maxsize=4096)
-def _get_cc_for_ip(ip_str):
-    cc = None
-    data = mmdb.get(ip_str)
-    if data and 'country' in data:
-        cc = data['country']['iso_code']
-    return cc
+def _rtt_stats(rtts, counts):
+    '''
+    Return (min, median, mean, 95th percentile) arrays of the RTTs of each
+    result, all at once. rtts is a flat array of every result's RTTs, the
+    first counts[0] of them the first result's and so on. Every result needs
+    at least one RTT. The median is exactly what statistics.median() gives.
+    '''
+    starts = numpy.cumsum(counts) - counts
+    result_idx = numpy.repeat(numpy.arange(len(counts)), counts)
+    # one row per result, padded out to the most RTTs any result has (a
+    # handful of pings), and each row sorted
+    by_result = numpy.full((len(counts), counts.max()), numpy.inf)
+    by_result[result_idx, numpy.arange(len(rtts)) - starts[result_idx]] = rtts
+    by_result.sort(axis=1)
+    rows = numpy.arange(len(counts))
+    # the middle one, or the lower of the middle two
+    mid = (counts - 1) // 2
+    median = (by_result[rows, mid] + by_result[rows, mid + 1 - counts % 2]) / 2
+    mean = numpy.bincount(result_idx, weights=rtts) / counts
+    # linear interpolation between the closest ranks, like numpy.percentile()
+    rank = (counts - 1) * 0.95
+    below = numpy.floor(rank).astype(numpy.int64)
+    above = numpy.minimum(below + 1, counts - 1)
+    p95 = by_result[rows, below] + \
+        (by_result[rows, above] - by_result[rows, below]) * (rank - below)
+    return by_result[:, 0], median, mean, p95
 
 
-@lru_cache(maxsize=4096)
-def _get_city_name_for_ip(ip_str):
-    name = None
-    data = mmdb.get(ip_str)
-    if data and 'city' in data and 'names' in data['city'] \
-            and 'en' in data['city']['names']:
-        name = data['city']['names']['en']
-    return name
+def _csv_rows(batch, rtt_stats=False):
+    '''
+    Turn a batch of (msm_id, projected result) into CSV rows, all but the id
+    column, which is only known once all the batches before are done. Return
+    the number of results, a dict of msm_id to the rows of that measurement,
+    and the geo records resolved for the batch, to be cached. Results without
+    a single RTT are left out.
+    '''
+    num_results = len(batch)
+    counts = numpy.array([len(res[2]) for _, res in batch], dtype=numpy.int64)
+    batch = [item for item, count in zip(batch, counts) if count]
+    counts = counts[counts > 0]
+    if not batch:
+        return num_results, {}, geo.take_new()
+    rtts = numpy.fromiter(
+        (rtt for _, res in batch for rtt in res[2]), dtype=float,
+        count=counts.sum())
+    min_rtt, median_rtt, mean_rtt, p95_rtt = _rtt_stats(rtts, counts)
+    sent = numpy.array([res[3] for _, res in batch], dtype=numpy.int64)
+    packetloss = 1 - counts / sent
+    rows = {}
+    for i, (msm_id, (src_ip, dst_ip, _, _)) in enumerate(batch):
+        src, dst = geo.resolve(src_ip), geo.resolve(dst_ip)
+        row = [
+            src_ip, src.city_code, src.city_name, src.country,
+            dst_ip, dst.city_code, dst.city_name, dst.country,
+            median_rtt[i].item()/2,
+            # lets glue drop measurements it already has when combining CSVs
+            msm_id,
+        ]
+        if rtt_stats:
+            row += [min_rtt[i].item(), median_rtt[i].item(),
+                    mean_rtt[i].item(), p95_rtt[i].item(),
+                    packetloss[i].item()]
+        rows.setdefault(msm_id, []).append(row)
+    return num_results, rows, geo.take_new()
 
 
-@lru_cache(maxsize=4096)
-def _get_city_code_for_ip(ip_str):
-    cc = None
-    data = mmdb.get(ip_str)
-    if data and 'city' in data:
-        cc = data['city']['geoname_id']
-    return cc
+def _init_worker(mmdb_fname, geo_cache_fname):
+    # every worker gets its own reader (memory mapped, so they still share
+    # the database's pages) and its own copy of the geo cache. Only the main
+    # process writes the cache.
+    global geo
+    geo = GeoResolver(mmdb_fname, geo_cache_fname)
 
-def _calc_avg_rtt(res):
-    assert 'result' in res
-    rtts = []
-    for rtt in res['result']:
-        if 'rtt' not in rtt: continue
-        rtts.append(rtt['rtt'])
-    if len(rtts) < 1: return -1
-    return median(rtts)
 
+def _measurements(results):
+    '''
+    Group (msm_id, result) by measurement into (msm_id, digest, projected
+    results), where the digest changes whenever anything we use from the
+    measurement's results does.
+    '''
+    def done():
+        digest = hashlib.sha1(repr(projected).encode('utf-8')).hexdigest()
+        return msm_id, digest, projected
 
-def main(args):
-    global mmdb
-    mmdb = maxminddb.open_database(args.mmdb)
-    results = load_results(args)
+    msm_id, projected = None, []
+    for next_msm_id, result in results:
+        if next_msm_id != msm_id and projected:
+            yield done()
+            projected = []
+        msm_id = next_msm_id
+        projected.append(project_result(result))
+    if projected:
+        yield done()
+
+
+def _batches(measurements, batch_size):
+    '''
+    Group (msm_id, digest, projected results) into batches of about
+    batch_size results, never splitting a measurement across batches. Yield
+    the (msm_id, digest) of each batch's measurements along with the batch of
+    (msm_id, projected result).
+    '''
+    msms, batch = [], []
+    for msm_id, digest, projected in measurements:
+        msms.append((msm_id, digest))
+        batch.extend((msm_id, res) for res in projected)
+        if len(batch) >= batch_size:
+            yield msms, batch
+            msms, batch = [], []
+    if msms:
+        yield msms, batch
+
+
+def _row_batches(args, batches):
+    ''' Yield the measurements and _csv_rows() of every batch, in order '''
+    if args.jobs <= 1:
+        for msms, batch in batches:
+            yield msms, _csv_rows(batch, args.rtt_stats)
+        return
+    with Pool(args.jobs, initializer=_init_worker,
+              initargs=(args.mmdb, args.geo_cache)) as pool:
+        pending = deque()
+        for msms, batch in batches:
+            pending.append((msms, pool.apply_async(
+                _csv_rows, (batch, args.rtt_stats))))
+            # keep every worker busy, but don't read further ahead than that
+            while len(pending) > 2 * args.jobs:
+                msms, rows = pending.popleft()
+                yield msms, rows.get()
+        while pending:
+            msms, rows = pending.popleft()
+            yield msms, rows.get()
+
+
+def _fieldnames(args):
+    fieldnames = ['id', 'src', 'src_city', 'src_city_name', 'src_country',
+                  'dst', 'dst_city', 'dst_city_name', 'dst_country',
+                  'latency', 'msm']
+    if args.rtt_stats:
+        fieldnames += RTT_STATS_FIELDS
+    return fieldnames
+
+
+def _manifest_params(args):
+    # if any of these changed, every row could have too
+    return {
+        'results': os.path.abspath(args.results),
+        'output': os.path.abspath(args.output),
+        'fieldnames': _fieldnames(args),
+        'mmdb_build_epoch': geo.build_epoch,
+    }
+
+
+def _load_manifest(args):
+    '''
+    Return the manifest of what's in the CSV from the last run, or None if we
+    have to start over. If the last run died while appending to the CSV,
+    the rows it didn't get to record in the manifest are cut off again.
+    '''
+    if args.from_scratch or not os.path.exists(args.manifest):
+        return None
+    with open(args.manifest, 'rt') as fd:
+        manifest = json.load(fd)
+    if manifest['params'] != _manifest_params(args):
+        log('Parameters or MaxMind DB changed since the last run, starting '
+            'over')
+        return None
+    if not os.path.exists(args.output) or \
+            os.path.getsize(args.output) < manifest['csv_size']:
+        log(args.output, 'is not what we left it as, starting over')
+        return None
+    if os.path.getsize(args.output) > manifest['csv_size']:
+        log('Cutting off rows the last run didn\'t finish writing')
+        os.truncate(args.output, manifest['csv_size'])
+    return manifest
+
+
+def _save_manifest(args, manifest):
+    tmp_fname = args.manifest + '.tmp'
+    with open(tmp_fname, 'wt') as fd:
+        json.dump(manifest, fd)
+    os.replace(tmp_fname, args.manifest)
+
+
+def _rewrite_csv(args, order, entries):
+    '''
+    Write the rows of the measurements in order (msm_ids) to a new CSV with
+    fresh ids, taking them from where entries (msm_id -> [digest, byte offset,
+    number of rows]) says they are in the current one. Update entries to
+    where they are in the new CSV, and return its size and the next id.
+    '''
+    tmp_fname = args.output + '.tmp'
     counter = 0
-    total_count = 0
-    with open(args.output, 'wt') as fd:
-        fieldnames = ['id', 'src', 'src_city', 'src_city_name', 'src_country',
-                      'dst', 'dst_city', 'dst_city_name', 'dst_country',
-                      'latency']
-        writer = csv.DictWriter(fd, fieldnames=fieldnames)
-        writer.writeheader()
-        for msm_id in results:
-            for result in results[msm_id]:
-                total_count += 1
-                rtt = _calc_avg_rtt(result)
-                if rtt < 0: continue
-                src_ip = result['from']
-                dst_ip = result['dst_addr']
-                writer.writerow({
-                    'id': counter,
-                    'src': src_ip,
-                    'src_city': _get_city_code_for_ip(src_ip),
-                    'src_city_name': _get_city_name_for_ip(src_ip),
-                    'src_country': _get_cc_for_ip(src_ip),
-                    'dst': dst_ip,
-                    'dst_city': _get_city_code_for_ip(dst_ip),
-                    'dst_city_name': _get_city_name_for_ip(dst_ip),
-                    'dst_country': _get_cc_for_ip(dst_ip),
-                    'latency': rtt/2
-                })
+    with open(args.output, 'rb') as inf, open(tmp_fname, 'wb') as outf:
+        outf.write(inf.readline())
+        for msm_id in order:
+            entry = entries[msm_id]
+            inf.seek(entry[1])
+            entry[1] = outf.tell()
+            for _ in range(entry[2]):
+                _, rest = inf.readline().split(b',', 1)
+                outf.write(str(counter).encode('utf-8') + b',' + rest)
                 counter += 1
-    log('Got {}/{} ({}%) good ping measurements written to'
-        .format(counter, total_count, int(100*counter/total_count)), args.output)
-    log('country', _get_cc_for_ip.cache_info())
-    log('city', _get_city_code_for_ip.cache_info())
+        size = outf.tell()
+    os.replace(tmp_fname, args.output)
+    return size, counter
+
+
+def main(args):
+    global geo
+    geo = GeoResolver(args.mmdb, args.geo_cache, log)
+    manifest = _load_manifest(args)
+    if manifest is None:
+        manifest = {'params': _manifest_params(args), 'csv_size': 0,
+                    'next_id': 0, 'measurements': {}}
+    # msm_id -> [digest, byte offset of its first row, number of rows]
+    entries = manifest['measurements']
+    old_msm_ids = set(entries)
+    counter = manifest['next_id']
+    # every measurement in the results, in order, and those whose results
+    # changed since the last run
+    order, changed = [], []
+    total_count = 0
 
+    def new_or_changed(measurements):
+        for msm_id, digest, projected in measurements:
+            order.append(msm_id)
+            if msm_id in entries:
+                if entries[msm_id][0] == digest:
+                    continue
+                changed.append(msm_id)
+            yield msm_id, digest, projected
+
+    log('streaming results from', args.results, 'with', args.jobs, 'jobs')
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    with open(args.output, 'ab' if manifest['csv_size'] else 'wb') as fd:
+        if not manifest['csv_size']:
+            writer.writerow(_fieldnames(args))
+            fd.write(buf.getvalue().encode('utf-8'))
+            buf.seek(0)
+            buf.truncate()
+        # one result at a time, so memory doesn't grow with the campaign
+        batches = _batches(
+            new_or_changed(_measurements(iter_results(args.results, log))),
+            args.batch_size)
+        # batches come back in file order, so ids are the same for any
+        # number of jobs. Rows of new and changed measurements are appended
+        # with ids continuing where the CSV left off
+        for msms, (num_results, rows, geo_records) in _row_batches(
+                args, batches):
+            total_count += num_results
+            geo.update(geo_records)
+            for msm_id, digest in msms:
+                msm_rows = rows.get(msm_id, [])
+                for row in msm_rows:
+                    writer.writerow([counter] + row)
+                    counter += 1
+                entries[msm_id] = [digest, fd.tell(), len(msm_rows)]
+                fd.write(buf.getvalue().encode('utf-8'))
+                buf.seek(0)
+                buf.truncate()
+        csv_size = fd.tell()
+    gone = old_msm_ids - set(order)
+    log('{} new and {} changed measurements with {} results, {} gone'.format(
+        len(order) - (len(old_msm_ids) - len(gone)), len(changed),
+        total_count, len(gone)))
+    if changed or gone:
+        log('Rewriting', args.output, 'without the old rows of changed and '
+            'gone measurements')
+        for msm_id in gone:
+            del entries[msm_id]
+        csv_size, counter = _rewrite_csv(args, order, entries)
+    log('{} rows in {}'.format(counter, args.output))
+    manifest.update({'csv_size': csv_size, 'next_id': counter})
+    _save_manifest(args, manifest)
+    if args.jobs <= 1:
+        log('Looked up', geo.lookups, 'IPs in', args.mmdb)
+    geo.save()
 
 
 if __name__ == '__main__':
@@ -107,10 +316,35 @@ if __name__ == '__main__':
     parser.add_argument('--mmdb', type=str, help='Path to MaxMind DB',
                         default='data/GeoLite2-City.mmdb')
     parser.add_argument(
-        '--results', type=str, default='cache/all-pairs-results.json',
-        help='Output from 04-fetch-all-pairs-results.py')
+        '--geo-cache', type=str, default='cache/geo-cache.json',
+        help='File in which to cache where IPs are according to --mmdb, '
+        'shared by all the scripts')
+    parser.add_argument(
+        '--results', type=str, default='cache/all-pairs-results.jsonl',
+        help='Output from 04-fetch-all-pairs-results.py, the --campaign-db '
+        'it wrote to (.sqlite), or the JSON file it used to write')
     parser.add_argument('--output', type=str, default='data/all-pairs.csv')
+    parser.add_argument(
+        '--manifest', type=str, default='cache/all-pairs-csv-manifest.json',
+        help='File in which to remember which measurements are in --output '
+        'already, so the next run only has to add new ones')
+    parser.add_argument(
+        '--from-scratch', action='store_true',
+        help='Ignore --manifest and regenerate the whole CSV')
+    parser.add_argument(
+        '--rtt-stats', action='store_true',
+        help='Add the min, median, mean and 95th percentile RTT and the '
+        'packet loss of each result as extra columns')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of worker processes doing the RTT math and geo lookups')
+    parser.add_argument(
+        '--batch-size', type=int, default=10000, metavar='NUM',
+        help='Give workers about NUM results at a time, in whole '
+        'measurements')
     args = parser.parse_args()
+    if args.batch_size < 1:
+        fail_hard('--batch-size must be at least 1')
     for fname in [args.mmdb, args.results]:
         if not os.path.isfile(fname):
             fail_hard(fname, 'must exist')
@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from itertools import groupby
+from threading import RLock
+from urllib.parse import quote
+
+
+# what made a measurement
+STAGE_REACHABILITY = 1
+STAGE_ALL_PAIRS = 3
+
+SCHEMA_VERSION = 1
+# how many measurements' worth of results to read at a time
+PAGE_SIZE = 1000
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS probes (
+    prb_id INTEGER PRIMARY KEY,
+    address_v4 TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    msm_id INTEGER PRIMARY KEY,
+    stage INTEGER NOT NULL,
+    target TEXT,
+    target_prb_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS measurements_target ON measurements (target);
+CREATE INDEX IF NOT EXISTS measurements_target_prb_id
+    ON measurements (target_prb_id);
+CREATE INDEX IF NOT EXISTS measurements_stage ON measurements (stage);
+CREATE TABLE IF NOT EXISTS group_probes (
+    msm_id INTEGER NOT NULL,
+    prb_id INTEGER NOT NULL,
+    PRIMARY KEY (msm_id, prb_id)
+);
+CREATE INDEX IF NOT EXISTS group_probes_prb_id ON group_probes (prb_id);
+CREATE TABLE IF NOT EXISTS results (
+    msm_id INTEGER NOT NULL,
+    prb_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (msm_id, prb_id)
+);
+CREATE INDEX IF NOT EXISTS results_prb_id ON results (prb_id);
+'''
+
+
+def is_campaign_store(fname):
+    return fname.endswith('.sqlite')
+
+
+class CampaignStore:
+    '''
+    The state of a whole latency campaign in one SQLite database, so that
+    the scripts can ask each other's questions (which probes were reachable,
+    which groups already have a measurement, what the results of a
+    measurement are) with an indexed query instead of loading each other's
+    files.
+
+    - probes: every RIPE probe we know about, as RIPE described it
+    - measurements: every measurement 01 (STAGE_REACHABILITY) or 03
+      (STAGE_ALL_PAIRS) created, and its target
+    - group_probes: the probes each measurement pings the target from
+    - results: the latest result of each probe in each measurement
+
+    The database is in WAL mode, so any number of scripts can read it while
+    one of them writes. Writes go into a transaction that lasts until
+    commit(), so callers decide how many of them share one sync to disk.
+    One store can be used from several threads.
+
+    With readonly the database is opened read-only: it has to exist already,
+    and nothing we do takes its write lock.
+    '''
+    def __init__(self, fname, log, timeout=60, readonly=False):
+        self._fname = fname
+        self._log = log
+        self._lock = RLock()
+        self.readonly = readonly
+        if readonly:
+            fname = 'file:{}?mode=ro'.format(quote(os.path.abspath(fname)))
+        # isolation_level None: we say when transactions begin, not sqlite3
+        self._db = sqlite3.connect(fname, timeout=timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False, uri=readonly)
+        self._in_transaction = False
+        with self._lock:
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version not in ([SCHEMA_VERSION] if readonly
+                               else [0, SCHEMA_VERSION]):
+                raise Exception('{} has schema version {}, we only know {}'
+                                .format(self._fname, version, SCHEMA_VERSION))
+            if readonly:
+                return
+            # in WAL mode this still never corrupts the database, it can just
+            # lose the last transactions if the machine (not us) crashes
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            if version == 0:
+                self._db.execute('PRAGMA journal_mode = WAL')
+                self._db.executescript(SCHEMA)
+                self._db.execute(
+                    'PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def _write(self, sql, rows=None):
+        ''' Run sql (for every one of rows, if given) in the transaction '''
+        assert not self.readonly
+        with self._lock:
+            if not self._in_transaction:
+                # take the write lock now rather than halfway through
+                self._db.execute('BEGIN IMMEDIATE')
+                self._in_transaction = True
+            if rows is None:
+                self._db.execute(sql)
+            else:
+                self._db.executemany(sql, rows)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def commit(self):
+        ''' Make everything written since the last commit() durable '''
+        with self._lock:
+            if self._in_transaction:
+                self._db.execute('COMMIT')
+                self._in_transaction = False
+
+    def rollback(self):
+        ''' Throw away everything written since the last commit() '''
+        with self._lock:
+            if self._in_transaction:
+                self._db.execute('ROLLBACK')
+                self._in_transaction = False
+
+    @contextmanager
+    def batch(self):
+        '''
+        Commit everything written in the with block at its end, or roll it
+        back (along with anything else not committed yet) if it raises
+        '''
+        with self._lock:
+            try:
+                yield self
+            except BaseException:
+                self.rollback()
+                raise
+            self.commit()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._db.close()
+
+    def add_probes(self, probes):
+        ''' Add (or update) RIPE probe descriptions '''
+        self._write(
+            'INSERT OR REPLACE INTO probes VALUES (?, ?, ?)',
+            ((int(p['id']), p.get('address_v4'), json.dumps(p))
+             for p in probes))
+
+    def probes(self):
+        ''' Return the RIPE descriptions of every probe '''
+        return [json.loads(data) for data, in self._query(
+            'SELECT data FROM probes ORDER BY prb_id')]
+
+    def add_measurement(self, msm_id, stage, target, probes,
+                        target_prb_id=None):
+        '''
+        Add a measurement of target (an IP, and probe target_prb_id if it is
+        one) from probes, replacing whatever we knew about msm_id before. If
+        target is None it's the address of target_prb_id in probes.
+        '''
+        msm_id = int(msm_id)
+        if target is None and target_prb_id is not None:
+            rows = self._query(
+                'SELECT address_v4 FROM probes WHERE prb_id = ?',
+                (int(target_prb_id),))
+            target = rows[0][0] if rows else None
+        self._write('DELETE FROM group_probes WHERE msm_id = ?', [(msm_id,)])
+        self._write(
+            'INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?)',
+            [(msm_id, stage, target,
+              None if target_prb_id is None else int(target_prb_id))])
+        self._write('INSERT INTO group_probes VALUES (?, ?)',
+                    ((msm_id, int(p)) for p in set(probes)))
+
+    def msm_ids(self, stage):
+        ''' Return the set of IDs of all measurements made by stage '''
+        return {msm_id for msm_id, in self._query(
+            'SELECT msm_id FROM measurements WHERE stage = ?', (stage,))}
+
+    def add_results(self, msm_id, results):
+        '''
+        Replace the results of msm_id with results, a list of (prb_id,
+        result) where result is anything json.dumps() takes
+        '''
+        msm_id = int(msm_id)
+        self._write('DELETE FROM results WHERE msm_id = ?', [(msm_id,)])
+        self._write('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                    ((msm_id, int(prb_id), json.dumps(result))
+                     for prb_id, result in results))
+
+    def reachability(self):
+        '''
+        Yield (target_prb_id, msm_id, [results]) for every reachability
+        measurement, with an empty list if it has no results yet
+        '''
+        last_msm_id = -1
+        while True:
+            # a page of measurements at a time, not all their results at once
+            rows = self._query(
+                'SELECT m.target_prb_id, m.msm_id, r.data FROM ('
+                '  SELECT msm_id, target_prb_id FROM measurements'
+                '  WHERE stage = ? AND msm_id > ? ORDER BY msm_id LIMIT ?'
+                ') m LEFT JOIN results r USING (msm_id) '
+                'ORDER BY m.msm_id, r.rowid',
+                (STAGE_REACHABILITY, last_msm_id, PAGE_SIZE))
+            if not rows:
+                return
+            for (prb_id, msm_id), msm_rows in groupby(
+                    rows, key=lambda row: row[:2]):
+                yield prb_id, msm_id, [json.loads(data)
+                                       for _, _, data in msm_rows
+                                       if data is not None]
+            last_msm_id = rows[-1][1]
+
+    def iter_results(self, stage=STAGE_ALL_PAIRS):
+        '''
+        Yield (msm_id, result) for every result of every measurement of
+        stage, in measurement order. Only a measurement's worth of results is
+        read at a time.
+        '''
+        msm_ids = self.msm_ids(stage)
+        # and those we have results of, but that no stage told us about, like
+        # results 04 fetched for measurements only in a text file
+        msm_ids |= {msm_id for msm_id, in self._query(
+            'SELECT DISTINCT msm_id FROM results WHERE msm_id NOT IN '
+            '(SELECT msm_id FROM measurements)')}
+        for msm_id in sorted(msm_ids):
+            # in the order they were added, like RIPE gave them
+            for data, in self._query(
+                    'SELECT data FROM results WHERE msm_id = ? '
+                    'ORDER BY rowid', (msm_id,)):
+                yield str(msm_id), json.loads(data)
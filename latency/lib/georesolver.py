@@ -0,0 +1,112 @@
+import fcntl
+import json
+import maxminddb
+import os
+import tempfile
+from collections import namedtuple
+
+
+# what we want to know about an IP. Any of these can be None if the database
+# doesn't know
+GeoRecord = namedtuple('GeoRecord', ['city_code', 'city_name', 'country'])
+
+
+class GeoResolver:
+    '''
+    Looks up where IPs are in a MaxMind City database, at most once per IP.
+    Records are cached in memory, and in the JSON file cache_fname (if given)
+    so that the next script resolving the same IPs doesn't have to. The file
+    is thrown away if it was written for a different build of the database.
+    '''
+    def __init__(self, mmdb_fname, cache_fname=None, log=None):
+        self._mmdb = maxminddb.open_database(mmdb_fname)
+        self.build_epoch = self._mmdb.metadata().build_epoch
+        self._cache_fname = cache_fname
+        self._log = log
+        self._records = {}
+        # IPs resolved since the last take_new()/save()
+        self._new = {}
+        self.lookups = 0
+        if cache_fname:
+            self._records = self._read_cache()
+            if log:
+                log('Loaded', len(self._records), 'cached geo records from',
+                    cache_fname)
+
+    def _read_cache(self):
+        if not os.path.exists(self._cache_fname):
+            return {}
+        try:
+            with open(self._cache_fname, 'rt') as fd:
+                cache = json.load(fd)
+            build_epoch, records = cache['build_epoch'], cache['records']
+            records = {ip: GeoRecord(*rec) for ip, rec in records.items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # it's only a cache: start over rather than not start at all
+            if self._log:
+                self._log('Warning:', self._cache_fname, 'is unreadable, '
+                          'ignoring it:', e)
+            return {}
+        if build_epoch != self.build_epoch:
+            if self._log:
+                self._log(self._cache_fname, 'is for another build of the '
+                          'MaxMind DB, ignoring it')
+            return {}
+        return records
+
+    def resolve(self, ip):
+        ''' Return the GeoRecord of ip '''
+        rec = self._records.get(ip)
+        if rec is None:
+            self.lookups += 1
+            data = self._mmdb.get(ip) or {}
+            city = data.get('city')
+            rec = GeoRecord(
+                city['geoname_id'] if city else None,
+                city['names'].get('en') if city and 'names' in city else None,
+                data['country']['iso_code'] if 'country' in data else None)
+            self._records[ip] = self._new[ip] = rec
+        return rec
+
+    def has_city(self, ip):
+        return self.resolve(ip).city_code is not None
+
+    def take_new(self):
+        '''
+        Return the records resolved since last time, like for a worker
+        process to hand them to the resolver that will save() them.
+        '''
+        new, self._new = self._new, {}
+        return new
+
+    def update(self, records):
+        ''' Add records from another resolver's take_new() '''
+        self._records.update(records)
+        self._new.update(records)
+
+    def save(self):
+        '''
+        Add the records resolved since the last save() to the cache file, if
+        we have one. Records another script saved in the meantime are kept.
+        '''
+        if not self._cache_fname or not self._new:
+            return
+        # so another script's records saved in the meantime can't be lost
+        with open(self._cache_fname + '.lock', 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            records = self._read_cache()
+            records.update(self._records)
+            # a temporary file of our own, so that nobody ever sees a
+            # half-written cache
+            tmp_fd, tmp_fname = tempfile.mkstemp(
+                dir=os.path.dirname(self._cache_fname) or '.',
+                prefix=os.path.basename(self._cache_fname) + '.')
+            try:
+                with os.fdopen(tmp_fd, 'wt') as fd:
+                    json.dump({'build_epoch': self.build_epoch,
+                               'records': records}, fd)
+                os.replace(tmp_fname, self._cache_fname)
+            except BaseException:
+                os.remove(tmp_fname)
+                raise
+        self._new = {}
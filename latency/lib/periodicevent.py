@@ -27,6 +27,10 @@ class PeriodicEvent():
             self._log('Warning: No _end_event so this thread will never die')
         self._thread.start()
 
+    def wait(self):
+        assert self._thread != None
+        self._thread.join()
+
     def _runit(self):
         self._func(*self._args, **self._kwargs)
 
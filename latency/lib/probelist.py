@@ -3,13 +3,17 @@ import json
 from datetime import datetime, timedelta
 import urllib.request
 import fcntl
+from lib.resultsmanager import load_measurements
 
 
 class ProbeList:
-    def __init__(self, args, log, mmdb):
+    def __init__(self, args, log, geo, db=None):
         self._args = args
         self._log = log
-        self._mmdb = mmdb
+        # a GeoResolver
+        self._geo = geo
+        # a CampaignStore, if any
+        self._db = db
         fname = args.probe_list
         if not os.path.exists(fname):
             log.notice(args.probe_list, 'doesn\'t exist. Need to get it')
@@ -30,6 +34,9 @@ class ProbeList:
                 with open(fname, 'wt') as fd:
                     json.dump(self._probes, fd, indent=2)
         log.notice(len(self._probes), 'probes known')
+        if db is not None and not db.readonly:
+            with db.batch():
+                db.add_probes(self._probes)
 
     @staticmethod
     def lock_fd(fd):
@@ -72,37 +79,47 @@ class ProbeList:
 
     def group_probes_by_city(self):
         log = self._log
-        mmdb = self._mmdb
+        geo = self._geo
         self._city_groups = {}
         next_unknown_city_code = -1
         no_city = 0
         for probe in self._probes:
             ip = probe['address_v4']
-            data = mmdb.get(ip)
-            if not data or 'city' not in data:
+            city_code = geo.resolve(ip).city_code
+            if city_code is None:
                 city_code = next_unknown_city_code
                 #next_unknown_city_code -= 1
                 no_city += 1
-            else:
-                city_code = data['city']['geoname_id']
             if city_code not in self._city_groups:
                 self._city_groups[city_code] = []
             self._city_groups[city_code].append(probe)
         log(len(self._city_groups), 'city groups from', len(self._probes),
             'probes and', no_city, 'probes without city data')
 
-    def add_reachability_info(self):
+    def _reachability_results(self):
+        '''
+        Yield (prb_id, results) for every probe whose reachability measurement
+        we have results for, from the database if we have one
+        '''
         args = self._args
+        if self._db is not None:
+            for prb_id, _, results in self._db.reachability():
+                # the database can't tell no results from none fetched yet
+                if results:
+                    yield prb_id, results
+            return
+        # with whatever 01 checkpointed since its last snapshot
+        measurements = load_measurements(args.measurements_file, self._log)
+        for prb_id in measurements:
+            if not 'result' in measurements[prb_id]: continue
+            yield prb_id, measurements[prb_id]['result']
+
+    def add_reachability_info(self):
         log = self._log
         reachable_results = 0
         total_results = 0
-        with open(args.measurements_file, 'rt') as fd:
-            ProbeList.lock_fd(fd)
-            try: measurements = json.load(fd)
-            finally: ProbeList.unlock_fd(fd)
-        for prb_id in measurements:
-            if not 'result' in measurements[prb_id]: continue
-            result = measurements[prb_id]['result']
+        probes = {str(probe['id']): probe for probe in self._probes}
+        for prb_id, result in self._reachability_results():
             if len(result) < 1:
                 log.warn('There is no result from prb', prb_id, '???')
                 continue
@@ -115,11 +132,9 @@ class ProbeList:
             is_reachable = avg_rtt > 0
             if is_reachable:
                 reachable_results += 1
-            for probe in self._probes:
-                if str(probe['id']) == str(prb_id):
-                    probe['reachable'] = is_reachable
-                    #log.debug('Marking prb', prb_id, 'as reachable', is_reachable)
-                    break
+            if str(prb_id) in probes:
+                probes[str(prb_id)]['reachable'] = is_reachable
+                #log.debug('Marking prb', prb_id, 'as reachable', is_reachable)
         log('{}/{} probes with results were reachable.'
             .format(reachable_results, total_results))
 
@@ -205,27 +220,24 @@ class ProbeList:
 
 
     def assert_all_probes_have_city(self):
-        mmdb = self._mmdb
+        geo = self._geo
         for p in self._probes:
-            data = mmdb.get(p['address_v4'])
-            assert data and 'city' in data
+            assert geo.has_city(p['address_v4'])
 
     @property
     def probes_with_a_city(self):
-        mmdb = self._mmdb
+        geo = self._geo
         for p in self._probes:
-            data = mmdb.get(p['address_v4'])
-            if not data or 'city' not in data:
+            if not geo.has_city(p['address_v4']):
                 continue
             yield p
 
     @property
     def num_probes_with_a_city(self):
-        mmdb = self._mmdb
+        geo = self._geo
         count = 0
         for p in self._probes:
-            data = mmdb.get(p['address_v4'])
-            if not data or 'city' not in data:
+            if not geo.has_city(p['address_v4']):
                 continue
             count += 1
         return count
@@ -0,0 +1,124 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+
+# HTTP statuses worth trying again after a while: we're being rate limited,
+# or RIPE's gateways are having a bad moment
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# longest we wait between two attempts at the same measurement, in seconds
+MAX_BACKOFF = 120
+
+
+class TokenBucket:
+    '''
+    Lets callers of take() through at rate per second on average, and up to
+    burst of them at once after a quiet spell. Thread safe.
+    '''
+    def __init__(self, rate, burst):
+        assert rate > 0 and burst >= 1
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        ''' Block until there's a token, and take it '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._last)*self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class ResultFetcher:
+    '''
+    Fetches the latest results of measurements from the RIPE Atlas API (or
+    whatever --api-url points at), several at once but no faster than --rate
+    requests per second overall. Gateway errors, rate limiting and network
+    trouble are retried with exponential backoff.
+    '''
+    def __init__(self, args, log):
+        self._args = args
+        self._log = log
+        self._bucket = TokenBucket(args.rate, args.burst)
+
+    def _url(self, msm_id):
+        return '{}/api/v2/measurements/{}/latest'.format(
+            self._args.api_url.rstrip('/'), msm_id)
+
+    def fetch(self, msm_id):
+        '''
+        Return the latest results of msm_id, or None if we couldn't get them
+        '''
+        args = self._args
+        log = self._log
+        request = Request(self._url(msm_id),
+                          headers={'Accept': 'application/json'})
+        for attempt in range(args.retries + 1):
+            retry_after = None
+            self._bucket.take()
+            log.debug('Fetching result for', msm_id)
+            try:
+                with urlopen(request, timeout=args.timeout) as resp:
+                    return json.loads(resp.read().decode('utf-8'))
+            except HTTPError as e:
+                if e.code not in RETRY_STATUSES:
+                    log.warn('Issue fetching results for msm', msm_id, ':', e)
+                    return None
+                error = e
+                retry_after = e.headers.get('Retry-After')
+            except (URLError, HTTPException, OSError, ValueError) as e:
+                # timeouts, dropped connections, truncated JSON
+                error = e
+            if attempt == args.retries:
+                break
+            # full jitter, so threads that failed together don't all come
+            # back at once
+            delay = random.uniform(
+                0, min(MAX_BACKOFF, args.backoff * 2**attempt))
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            log.info('Fetching msm', msm_id, 'failed:', error, '- trying '
+                     'again in {:.1f}s'.format(delay))
+            time.sleep(delay)
+        log.warn('Giving up on msm', msm_id, 'after', args.retries + 1,
+                 'attempts:', error)
+        return None
+
+    def fetch_all(self, msm_ids):
+        '''
+        Yield (msm_id, results or None) for every one of msm_ids, in the same
+        order, fetching up to --threads of them at once.
+        '''
+        threads = self._args.threads
+        with ThreadPoolExecutor(threads) as pool:
+            pending = deque()
+            try:
+                for msm_id in msm_ids:
+                    pending.append((msm_id, pool.submit(self.fetch, msm_id)))
+                    # keep every thread busy, but don't get so far ahead of
+                    # a slow measurement that lots of results pile up
+                    while len(pending) > 4 * threads:
+                        msm_id, future = pending.popleft()
+                        yield msm_id, future.result()
+                while pending:
+                    msm_id, future = pending.popleft()
+                    yield msm_id, future.result()
+            finally:
+                # stopped early: don't start on the rest
+                for _, future in pending:
+                    future.cancel()
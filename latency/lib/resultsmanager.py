@@ -1,33 +1,173 @@
 import json
 import os
-from threading import RLock
+from lib.campaignstore import STAGE_REACHABILITY
+from lib.periodicevent import PeriodicEvent
+from threading import Event, RLock
 import fcntl
 import urllib
 from ripe.atlas.cousteau import AtlasLatestRequest
 import time
 
+def checkpoint_fname(measurements_file):
+    return measurements_file + '.log'
+
+
+def load_measurements(measurements_file, log):
+    '''
+    Return what ResultsManager knows about measurements: the last snapshot it
+    wrote to measurements_file, and whatever it checkpointed since
+    '''
+    measurements = {}
+    if os.path.isfile(measurements_file):
+        with open(measurements_file, 'rt') as fd:
+            log.info('Loading existing measurements from', measurements_file)
+            ResultsManager.lock_fd(fd)
+            try: measurements = json.load(fd)
+            finally: ResultsManager.unlock_fd(fd)
+    fname = checkpoint_fname(measurements_file)
+    if not os.path.isfile(fname):
+        return measurements
+    count = 0
+    with open(fname, 'rt') as fd:
+        for line in fd:
+            # the checkpoint we were writing when we died
+            if not line.endswith('\n'):
+                log.warn('Ignoring unfinished last line of', fname)
+                break
+            record = json.loads(line)
+            msm = measurements.setdefault(
+                record['prb_id'], {'msm_id': record['msm_id']})
+            if 'result' in record:
+                msm['result'] = record['result']
+            count += 1
+    log.info('Replayed', count, 'checkpointed records from', fname)
+    return measurements
+
+
 class ResultsManager:
-    def __init__(self, args, log):
+    '''
+    Keeps track of the reachability measurement of every probe, and its
+    result. Whatever is new is appended to a checkpoint log next to
+    measurements_file every --checkpoint-interval seconds, or as soon as there
+    are --checkpoint-records new things, so that a crash loses at most that
+    much. On startup the log is replayed on top of measurements_file, and on
+    close() folded into it.
+    '''
+    def __init__(self, args, log, db=None):
         self._args = args
         self._log = log
-        self._measurements = {}
+        # a CampaignStore to keep measurements and results in too, if any
+        self._db = db
         self._lock = RLock()
-        if os.path.isfile(args.measurements_file):
-            with open(args.measurements_file, 'rt') as fd:
-                log.info('Loading existing measurements from', args.measurements_file)
-                ResultsManager.lock_fd(fd)
-                try: self._measurements = json.load(fd)
-                finally: ResultsManager.unlock_fd(fd)
-        self._fetch_more_from_ripe()
-
-    def __del__(self):
+        self._measurements = load_measurements(args.measurements_file, log)
+        if db is not None:
+            self._load_from_db()
+        # the records not checkpointed yet
+        self._pending = []
+        self._checkpoint_fd = None
+        self._snapshot()
+        if db is not None:
+            self._save_to_db()
+        try:
+            self._fetch_more_from_ripe()
+        finally:
+            # keep what we did learn if RIPE failed us halfway
+            self.checkpoint()
+        # only now, so there's no thread left running if anything above
+        # fails and nobody ever close()s us
+        self._end_event = Event()
+        self._checkpointer = PeriodicEvent(
+            self.checkpoint, _run_interval=args.checkpoint_interval,
+            _end_event=self._end_event, _log_func=log,
+            _thread_name='checkpoint')
+
+    def close(self):
+        ''' Checkpoint one last time, and fold the log into a snapshot '''
+        self._end_event.set()
+        self._checkpointer.wait()
+        self._snapshot()
+        self._checkpoint_fd.close()
+
+    def _snapshot(self):
+        '''
+        Write everything to measurements_file and start a new checkpoint log.
+        The file is written next to the old one and renamed over it, and the
+        old log only truncated after that, so a crash leaves a snapshot and
+        a log that's already in it at worst.
+        '''
         args = self._args
-        msms = self._measurements
         with self._lock:
-            with open(args.measurements_file, 'wt') as fd:
-                ResultsManager.lock_fd(fd)
-                try: json.dump(msms, fd, indent=2)
-                finally: ResultsManager.unlock_fd(fd)
+            self.checkpoint()
+            tmp_fname = args.measurements_file + '.tmp'
+            with open(tmp_fname, 'wt') as fd:
+                json.dump(self._measurements, fd, indent=2)
+                ResultsManager._sync(fd)
+            os.replace(tmp_fname, args.measurements_file)
+            if self._checkpoint_fd is None:
+                self._checkpoint_fd = open(
+                    checkpoint_fname(args.measurements_file), 'at')
+            self._checkpoint_fd.truncate(0)
+            ResultsManager._sync(self._checkpoint_fd)
+
+    @staticmethod
+    def _sync(fd):
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    def checkpoint(self):
+        ''' Append what's new to the checkpoint log (and database) '''
+        with self._lock:
+            records, self._pending = self._pending, []
+            if not records:
+                return
+            self._checkpoint_fd.write(
+                ''.join(json.dumps(record) + '\n' for record in records))
+            ResultsManager._sync(self._checkpoint_fd)
+            if self._db is not None:
+                with self._db.batch():
+                    for record in records:
+                        self._add_to_db(record)
+        self._log.debug('Checkpointed', len(records), 'records')
+
+    def _add_to_db(self, record):
+        if 'result' in record:
+            self._db.add_results(record['msm_id'], [
+                (result['prb_id'], result) for result in record['result']])
+        else:
+            self._db.add_measurement(
+                record['msm_id'], STAGE_REACHABILITY, None,
+                [self._args.src_probe], target_prb_id=record['prb_id'])
+
+    def _record(self, record):
+        ''' Checkpoint record soon, or right now if enough are waiting '''
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) >= self._args.checkpoint_records:
+                self.checkpoint()
+
+    def _load_from_db(self):
+        ''' Add what the database knows and measurements_file doesn't '''
+        count = 0
+        with self._lock:
+            for prb_id, msm_id, results in self._db.reachability():
+                msm = self._measurements.setdefault(
+                    str(prb_id), {'msm_id': str(msm_id)})
+                if msm['msm_id'] != str(msm_id):
+                    continue
+                if results and 'result' not in msm:
+                    msm['result'] = results
+                    count += 1
+        self._log.info('Now have', len(self._measurements), 'measurements, '
+                       'with', count, 'results only the database had')
+
+    def _save_to_db(self):
+        ''' Add everything we know to the database '''
+        with self._db.batch():
+            for prb_id, msm in self._measurements.items():
+                record = {'prb_id': prb_id, 'msm_id': msm['msm_id']}
+                self._add_to_db(record)
+                if 'result' in msm:
+                    self._add_to_db(dict(record, result=msm['result']))
 
     def _fetch_more_from_ripe(self):
         args = self._args
@@ -101,10 +241,7 @@ class ResultsManager:
             args = self._args
             assert not self.have_measurement_for_probe(prb_id)
             msms[str(prb_id)] = {'msm_id': str(msm_id)}
-            #with open(args.measurements_file, 'wt') as fd:
-            #    ResultsManager.lock_fd(fd)
-            #    try: json.dump(msms, fd, indent=2)
-            #    finally: ResultsManager.unlock_fd(fd)
+            self._record({'prb_id': str(prb_id), 'msm_id': str(msm_id)})
 
     def recv_result(self, prb_id, msm_id, result):
         with self._lock:
@@ -114,8 +251,6 @@ class ResultsManager:
             assert self.have_measurement_for_probe(prb_id)
             assert str(msms[str(prb_id)]['msm_id']) == str(msm_id)
             msms[str(prb_id)]['result'] = result
-            #with open(args.measurements_file, 'wt') as fd:
-            #    ResultsManager.lock_fd(fd)
-            #    try: json.dump(msms, fd, indent=2)
-            #    finally: ResultsManager.unlock_fd(fd)
+            self._record({'prb_id': str(prb_id), 'msm_id': str(msm_id),
+                          'result': result})
 
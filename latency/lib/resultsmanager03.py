@@ -1,5 +1,8 @@
+import hashlib
 import json
 import os
+from array import array
+from lib.campaignstore import STAGE_ALL_PAIRS
 from threading import Thread, Event, RLock
 from queue import Empty, Queue
 import fcntl
@@ -8,51 +11,135 @@ from ripe.atlas.cousteau import AtlasLatestRequest
 import time
 
 
+def _group_key(target, probes):
+    '''
+    Return what identifies a measurement of target from the given probes, no
+    matter their order: (target, digest of the sorted probes, duplicates and
+    all). A digest takes much less memory than a tuple of hundreds of probe
+    IDs.
+    '''
+    probes = ' '.join(str(p) for p in sorted(probes))
+    return target, hashlib.sha1(probes.encode('utf-8')).digest()
+
+
 class ResultsManager:
-    def __init__(self, args, log, end_event):
+    def __init__(self, args, log, end_event, db=None):
         self._args = args
         self._log = log
         self._end_event = end_event
-        self._input = Queue(maxsize=1)
-        self._thread = Thread(target=self._enter)
-        self._thread.name = 'results'
-        self._thread.start()
+        # a CampaignStore to tell about measurements too, if any
+        self._db = db
+        # room for every worker to hand in a measurement while we're busy
+        # syncing the last ones to disk
+        self._input = Queue(maxsize=100)
         self._data = {}
+        # _group_key() -> how many measurements we have of that group, so
+        # have_inmsm() doesn't have to look at every one of them
+        self._index = {}
         self._lock = RLock()
-        self._write_every = 1
+        # --all-pairs-measurements is our write-ahead log: a line is appended
+        # for every measurement created, and a later line for the same msm
+        # wins. It's only rewritten from scratch by _compact().
+        self._wal = None
+        # lines in it, superseded ones included
+        self._num_records = 0
         if os.path.isfile(args.all_pairs_measurements):
-            self._read_data()
+            if not self._read_data() or self._num_records > len(self._data):
+                self._compact()
+        if db is not None:
+            self._add_missing_to_db()
+        self._wal = open(args.all_pairs_measurements, 'at')
+        self._thread = Thread(target=self._enter)
+        self._thread.name = 'results'
+        self._thread.start()
 
     def wait(self):
         assert self._thread != None
         self._thread.join()
 
     def _read_data(self):
+        '''
+        Load what's in the log. Returns False if its last line was cut off by
+        a crash while appending it, in which case that line is ignored.
+        '''
         log = self._log
         args = self._args
         log('Reading data from', args.all_pairs_measurements)
         with self._lock:
             with open(args.all_pairs_measurements, 'rt') as fd:
                 for line in fd:
+                    if not line.endswith('\n'):
+                        log.warn('Ignoring unfinished last line of',
+                                 args.all_pairs_measurements, repr(line))
+                        return False
                     words = line.split()
                     msm_id, target, probes = words[0], words[1], words[2:]
                     msm_id = int(msm_id)
-                    probes = [int(p) for p in probes]
+                    probes = array('I', sorted(int(p) for p in probes))
                     if msm_id in self._data:
                         log.warn('Msm', msm_id, 'already loaded. overwriting')
-                    self._data[msm_id] = {'target': target, 'probes': probes }
+                    self._set(msm_id, target, probes)
+                    self._num_records += 1
         log('Now know of', len(self._data), 'existing measurements')
+        return True
 
-    def _write_data(self):
+    def _add_missing_to_db(self):
+        ''' Tell the database about measurements it doesn't know of yet '''
+        with self._lock:
+            known = self._db.msm_ids(STAGE_ALL_PAIRS)
+            missing = [msm_id for msm_id in self._data if msm_id not in known]
+            with self._db.batch():
+                for msm_id in missing:
+                    self._add_to_db(msm_id)
+        if missing:
+            self._log('Added', len(missing), 'measurements to the database')
+
+    def _add_to_db(self, msm_id):
+        msm = self._data[msm_id]
+        self._db.add_measurement(
+            msm_id, STAGE_ALL_PAIRS, msm['target'], msm['probes'])
+
+    @staticmethod
+    def _format(msm_id, msm):
+        return '{} {} {}\n'.format(
+            msm_id, msm['target'], ' '.join([str(p) for p in msm['probes']]))
+
+    @staticmethod
+    def _sync(fd):
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    def _compact(self):
+        '''
+        Rewrite the log with one line per measurement. It's written next to
+        the old one and renamed over it, so a crash leaves one or the other.
+        '''
         log = self._log
-        args = self._args
-        log('Writing data to', args.all_pairs_measurements)
+        fname = self._args.all_pairs_measurements
+        tmp_fname = fname + '.tmp'
+        log('Compacting', fname)
         with self._lock:
-            with open(args.all_pairs_measurements, 'wt') as fd:
+            with open(tmp_fname, 'wt') as fd:
                 for msm_id in self._data:
-                    fd.write('{} {} {}\n'.format(
-                        msm_id, self._data[msm_id]['target'],
-                        ' '.join([str(p) for p in self._data[msm_id]['probes']])))
+                    fd.write(self._format(msm_id, self._data[msm_id]))
+                self._sync(fd)
+            os.replace(tmp_fname, fname)
+            self._num_records = len(self._data)
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = open(fname, 'at')
+
+    def _set(self, msm_id, target, probes):
+        ''' Remember msm_id measures target from probes. Hold the lock. '''
+        old = self._data.get(msm_id)
+        if old is not None:
+            old_key = _group_key(old['target'], old['probes'])
+            self._index[old_key] -= 1
+            if not self._index[old_key]:
+                del self._index[old_key]
+        self._data[msm_id] = {'target': target, 'probes': probes}
+        key = _group_key(target, probes)
+        self._index[key] = self._index.get(key, 0) + 1
 
     def _process(self, item):
         log = self._log
@@ -61,39 +148,46 @@ class ResultsManager:
         with self._lock:
             if msm_id in self._data:
                 log.warn('Already have msm', msm_id, 'overwriting')
-            self._data[msm_id] = {
-                'target': inmsm.target,
-                'probes': sorted(inmsm.probes),
-            }
+            self._set(msm_id, inmsm.target, array('I', sorted(inmsm.probes)))
+            self._wal.write(self._format(msm_id, self._data[msm_id]))
+            self._num_records += 1
+            if self._db is not None:
+                self._add_to_db(msm_id)
 
     def _enter(self):
         log = self._log
         log('Starting', self._thread.name)
-        count = 0
         while not self._input.empty() or not self._end_event.is_set():
-            try: item = self._input.get(timeout=0.5)
+            try: items = [self._input.get(timeout=0.5)]
             except Empty: continue
-            if item:
-                self._process(item)
-                count += 1
-                if count >= self._write_every:
-                    self._write_data()
-                    count = 0
-        self._write_data()
+            # and whatever else is already waiting, so it all shares one
+            # fsync. Never wait for more before making what we have durable
+            while True:
+                try: items.append(self._input.get_nowait())
+                except Empty: break
+            for item in items:
+                if item:
+                    self._process(item)
+            with self._lock:
+                self._sync(self._wal)
+                if self._db is not None:
+                    self._db.commit()
+            # mostly superseded lines: a measurement was redone a lot
+            if self._num_records > 2 * len(self._data) + 100:
+                self._compact()
+        with self._lock:
+            self._sync(self._wal)
+            if self._db is not None:
+                self._db.commit()
+            if self._num_records > len(self._data):
+                self._compact()
+            self._wal.close()
         log('Ending', self._thread.name)
 
     def recv(self, msm_id):
         self._input.put(msm_id)
 
     def have_inmsm(self, inmsm):
-        log = self._log
-        target = inmsm.target
-        probes = sorted(inmsm.probes)
-        have = False
+        key = _group_key(inmsm.target, inmsm.probes)
         with self._lock:
-            for msm_id in self._data:
-                msm = self._data[msm_id]
-                if msm['target'] == target:
-                    if msm['probes'] == probes:
-                        return True
-            return False
+            return key in self._index
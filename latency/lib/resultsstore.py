@@ -0,0 +1,243 @@
+import fcntl
+import gzip
+import json
+import os
+import zlib
+
+
+def project_result(result):
+    '''
+    Return just what the CSV needs of a RIPE ping result, as a fixed-order
+    (from, dst_addr, [RTT of every ping that came back], number of pings sent)
+    tuple. Stored results that already are one are fine too, as lists.
+    '''
+    if isinstance(result, list):
+        return tuple(result)
+    assert 'result' in result
+    return (result['from'], result['dst_addr'],
+            [rtt['rtt'] for rtt in result['result'] if 'rtt' in rtt],
+            len(result['result']))
+
+
+def is_results_store(fname):
+    return fname.endswith('.jsonl') or fname.endswith('.jsonl.gz')
+
+
+def _gzip_members(fd):
+    ''' Yield (offset, length, data) of every complete gzip member in fd '''
+    offset = 0
+    pending = b''
+    while True:
+        decomp = zlib.decompressobj(wbits=31)
+        out = []
+        length = 0
+        while not decomp.eof:
+            if not pending:
+                pending = fd.read(1024*1024)
+                if not pending:
+                    # the end, or a member that was never finished
+                    return
+            out.append(decomp.decompress(pending))
+            length += len(pending) - len(decomp.unused_data)
+            pending = decomp.unused_data
+        yield offset, length, b''.join(out)
+        offset += length
+
+
+def _lines(fd):
+    ''' Yield (offset, length, line) of every complete line in fd '''
+    offset = 0
+    for line in fd:
+        if not line.endswith(b'\n'):
+            return
+        yield offset, len(line), line
+        offset += len(line)
+
+
+class ResultsStore:
+    '''
+    Append-only store of the results of many measurements. fname has one line
+    of JSON, [msm_id, results], per measurement fetched; if fname ends in .gz
+    each line is its own gzip member so it can still be read on its own.
+    Results are either the raw dicts from RIPE or project_result() lists.
+
+    fname + '.idx' has a "msm_id offset length" line for every record, only
+    appended once the record is safely on disk, so it doubles as the list of
+    finished writes. Whatever comes after the last indexed record is a write
+    that didn't finish, and the store cuts it off when opened for writing.
+    Storing a measurement again supersedes its earlier record, which stays
+    in the file until compact().
+
+    Only one process can have a store open for writing, but any number can
+    read it meanwhile. Readers never see records that aren't indexed yet.
+    '''
+    def __init__(self, fname, log, writable=False):
+        self._fname = fname
+        self._index_fname = fname + '.idx'
+        self._compressed = fname.endswith('.gz')
+        self._log = log
+        self._writable = writable
+        # msm_id -> (offset, length) of its latest record
+        self._index = {}
+        # where the next record goes
+        self._end = 0
+        self._data_fd = None
+        self._index_fd = None
+        # before opening it to lock it creates it
+        have_index = os.path.exists(self._index_fname)
+        if writable:
+            self._index_fd = open(self._index_fname, 'ab')
+            try:
+                fcntl.flock(self._index_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise Exception('Someone else is writing to {}'.format(fname))
+        if have_index:
+            self._load_index()
+        elif os.path.exists(fname) and os.path.getsize(fname):
+            self._rebuild_index()
+        if writable:
+            self._data_fd = open(fname, 'ab')
+            self._data_fd.truncate(self._end)
+
+    def _load_index(self):
+        data_size = os.path.getsize(self._fname) \
+            if os.path.exists(self._fname) else 0
+        index_size = 0
+        with open(self._index_fname, 'rb') as fd:
+            for line in fd:
+                # a torn index line, or a record that isn't all there
+                if not line.endswith(b'\n'):
+                    break
+                msm_id, offset, length = line.decode('utf-8').split()
+                offset, length = int(offset), int(length)
+                if offset + length > data_size:
+                    break
+                self._index[msm_id] = (offset, length)
+                self._end = max(self._end, offset + length)
+                index_size += len(line)
+        if self._writable:
+            self._index_fd.truncate(index_size)
+
+    def _records(self, fd):
+        ''' Yield (msm_id, offset, length) of every record in fd '''
+        scan = _gzip_members if self._compressed else _lines
+        for offset, length, data in scan(fd):
+            msm_id = json.loads(data.decode('utf-8'))[0]
+            yield str(msm_id), offset, length
+
+    def _rebuild_index(self):
+        self._log('No index for', self._fname, 'so reading all of it to make '
+                  'one')
+        lines = []
+        with open(self._fname, 'rb') as fd:
+            for msm_id, offset, length in self._records(fd):
+                self._index[msm_id] = (offset, length)
+                self._end = offset + length
+                lines.append('{} {} {}\n'.format(msm_id, offset, length))
+        if self._writable:
+            self._index_fd.write(''.join(lines).encode('utf-8'))
+            self._sync(self._index_fd)
+
+    @staticmethod
+    def _sync(fd):
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    def __contains__(self, msm_id):
+        return str(msm_id) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def add(self, msm_id, results):
+        ''' Store the results of msm_id, superseding any we had before '''
+        assert self._writable
+        msm_id = str(msm_id)
+        data = (json.dumps([msm_id, results]) + '\n').encode('utf-8')
+        if self._compressed:
+            data = gzip.compress(data)
+        offset = self._end
+        self._data_fd.write(data)
+        self._sync(self._data_fd)
+        self._index_fd.write('{} {} {}\n'.format(
+            msm_id, offset, len(data)).encode('utf-8'))
+        self._sync(self._index_fd)
+        self._index[msm_id] = (offset, len(data))
+        self._end += len(data)
+
+    def _read(self, fd, offset, length):
+        fd.seek(offset)
+        data = fd.read(length)
+        if self._compressed:
+            data = gzip.decompress(data)
+        return json.loads(data.decode('utf-8'))[1]
+
+    def get(self, msm_id):
+        ''' Return the results of msm_id, or None if we don't have them '''
+        if str(msm_id) not in self._index:
+            return None
+        with open(self._fname, 'rb') as fd:
+            return self._read(fd, *self._index[str(msm_id)])
+
+    def iter_measurements(self):
+        '''
+        Yield (msm_id, results) of every measurement, in the order their
+        latest records were stored. Only one measurement is read at a time.
+        '''
+        if not self._index:
+            return
+        with open(self._fname, 'rb') as fd:
+            for msm_id, (offset, length) in sorted(
+                    self._index.items(), key=lambda item: item[1][0]):
+                yield msm_id, self._read(fd, offset, length)
+
+    def iter_results(self):
+        ''' Yield (msm_id, result) for every result of every measurement '''
+        for msm_id, results in self.iter_measurements():
+            for result in results:
+                yield msm_id, result
+
+    def compact(self):
+        '''
+        Rewrite the store with just the latest record of every measurement,
+        still in the same order. Anyone reading the store at the time has to
+        open it again.
+        '''
+        assert self._writable
+        old_size = self._end
+        tmp_fname = self._fname + '.tmp'
+        tmp_index_fname = self._index_fname + '.tmp'
+        index = {}
+        with open(self._fname, 'rb') as inf, \
+                open(tmp_fname, 'wb') as outf, \
+                open(tmp_index_fname, 'wb') as index_outf:
+            for msm_id, (offset, length) in sorted(
+                    self._index.items(), key=lambda item: item[1][0]):
+                inf.seek(offset)
+                index[msm_id] = (outf.tell(), length)
+                outf.write(inf.read(length))
+                index_outf.write('{} {} {}\n'.format(
+                    msm_id, *index[msm_id]).encode('utf-8'))
+            self._sync(outf)
+            self._sync(index_outf)
+        # if we die in between, there's no index and the next to open the
+        # store rebuilds it from whichever data file is there
+        os.remove(self._index_fname)
+        os.replace(tmp_fname, self._fname)
+        os.replace(tmp_index_fname, self._index_fname)
+        self._data_fd.close()
+        self._data_fd = open(self._fname, 'ab')
+        # keep holding the lock, now on the new index
+        self._index_fd.close()
+        self._index_fd = open(self._index_fname, 'ab')
+        fcntl.flock(self._index_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._index = index
+        self._end = sum(length for _, length in index.values())
+        self._log('Compacted', self._fname, 'from', old_size, 'to',
+                  self._end, 'bytes')
+
+    def close(self):
+        for fd in [self._data_fd, self._index_fd]:
+            if fd is not None:
+                fd.close()
+        self._data_fd = self._index_fd = None
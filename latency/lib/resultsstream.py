@@ -0,0 +1,101 @@
+import json
+import re
+from lib.campaignstore import CampaignStore, is_campaign_store
+from lib.resultsstore import ResultsStore, is_results_store
+
+
+# how much of the results file to read at a time
+CHUNK_SIZE = 1024*1024
+_WHITESPACE = re.compile(r'\s*')
+
+
+class _JSONReader:
+    '''
+    Reads a JSON document one token or value at a time, keeping only what it
+    hasn't parsed yet (and at least one chunk) in memory.
+    '''
+    def __init__(self, fd, chunk_size):
+        self._fd = fd
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read_more(self):
+        chunk = self._fd.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        ''' Skip whitespace and return the next character, or '' at the end. '''
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._read_more():
+                return self._buf[self._pos:self._pos+1]
+
+    def expect(self, chars):
+        ''' Consume and return the next character, which must be in chars. '''
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of {} at character {} of the '
+                             'buffer, got {!r}'.format(
+                                 chars, self._pos, c or 'the end'))
+        self._pos += 1
+        return c
+
+    def value(self):
+        ''' Parse and return the next whole JSON value. '''
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the very end of the buffer might go on in the
+                # next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read_more()
+
+
+def iter_results(fname, log=print, chunk_size=CHUNK_SIZE):
+    '''
+    Yield (msm_id, result) for every result in fname, in file order: either
+    a ResultsStore written by 04-fetch-all-pairs-results.py, a CampaignStore
+    it wrote to with --campaign-db, or the one big JSON object of measurement
+    IDs to lists of results it used to write. Only one measurement (stores)
+    or result (JSON) is ever in memory, not the whole file.
+    '''
+    if is_results_store(fname):
+        yield from ResultsStore(fname, log).iter_results()
+        return
+    if is_campaign_store(fname):
+        db = CampaignStore(fname, log, readonly=True)
+        try: yield from db.iter_results()
+        finally: db.close()
+        return
+    with open(fname, 'rt') as fd:
+        reader = _JSONReader(fd, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            msm_id = reader.value()
+            reader.expect(':')
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield msm_id, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+            if reader.expect(',}') == '}':
+                return